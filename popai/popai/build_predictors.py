@@ -3,10 +3,13 @@ from sklearn.model_selection import train_test_split, cross_val_predict, cross_v
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import confusion_matrix
 import numpy as np
+from scipy import sparse
 import keras
+import tensorflow as tf
 import matplotlib.pyplot as plt
 import seaborn as sns
 from tabulate import tabulate
+from popai.sfs import stack
 
 class RandomForestsSFS:
 
@@ -14,13 +17,11 @@ class RandomForestsSFS:
 
     def __init__(self, config, sfs, labels, user=False):
         self.config = config
-        self.sfs = []
-        self.labels = []
-        for key,value in sfs.items():
-            for thesfs in value:
-                self.sfs.append(thesfs)
-                self.labels.append(key)
-        self.sfs = np.array(self.sfs)
+        # sparse spectra are kept sparse, which the random forest accepts as is; the forest
+        # works on float32 features, so they are converted once rather than at every fit
+        self.sfs, self.labels = stacked_features(sfs, stack)
+        self.sfs = self.sfs.astype(np.float32) if sparse.issparse(self.sfs) \
+            else np.asarray(self.sfs, dtype=np.float32)
         if user:
             try:
                 self.labels = [int(x.split('_')[-1]) for x in labels]
@@ -31,10 +32,14 @@ class RandomForestsSFS:
                 raise ValueError(f"Model names must be 'Model_x', where x are integers ranging from 0 to n-1, where n is the number of models.")
         self.rng = np.random.default_rng(self.config['seed'])
 
-    def build_rf_sfs(self, ntrees=500):
+    def build_rf_sfs(self, ntrees=500, cores=None, max_samples=None, max_memory=None):
 
         """Build a random forest classifier that takes the
-        multidimensional SFS as input."""
+        multidimensional SFS as input. The trees are built on cores cores (-1 for all),
+        each from a bootstrap sample of max_samples datasets (a fraction if at most 1,
+        by default as many as in the training set). With max_memory (in MB), the
+        number of leaves of each tree is bounded so that the forest fits in
+        max_memory."""
         
         train_test_seed = self.rng.integers(2**32, size=1)[0]
 
@@ -42,7 +47,17 @@ class RandomForestsSFS:
         x_train, x_test, y_train, y_test = train_test_split(self.sfs,
                 self.labels, test_size=0.2, random_state=train_test_seed)
 
-        sfs_rf = RandomForestClassifier(n_estimators=ntrees, oob_score=True)
+        if max_samples is not None and max_samples > 1:
+            max_samples = int(max_samples)
+        max_leaf_nodes = None
+        if max_memory is not None:
+            # a tree with n leaves has 2n-1 nodes, each stored with 64 bytes and a
+            # float64 count per class
+            node_bytes = 64 + 8 * len(set(y_train))
+            max_leaf_nodes = max(2, int(max_memory * 2**20 / (ntrees * node_bytes) + 1) // 2)
+
+        sfs_rf = RandomForestClassifier(n_estimators=ntrees, oob_score=True, n_jobs=cores,
+                                        max_samples=max_samples, max_leaf_nodes=max_leaf_nodes)
 
         sfs_rf.fit(x_train, y_train)
         print("Out-of-Bag (OOB) Error:", 1.0 - sfs_rf.oob_score_)
@@ -59,7 +74,7 @@ class RandomForestsSFS:
         return sfs_rf, conf_matrix, conf_matrix_plot
 
     def predict(self, model, new_data):
-        new_data = np.array(new_data)
+        new_data = stack(new_data)
         predicted = model.predict(new_data)
         predicted_prob = model.predict_proba(new_data)
         headers = ["Model {}".format(i) for i in range(predicted_prob.shape[1])]
@@ -74,12 +89,9 @@ class CnnSFS:
 
     def __init__(self, config, sfs_2d, labels, user=False):
         self.config = config
-        self.sfs_2d = []
-        self.labels = []
-        for key,value in sfs_2d.items():
-            for thesfs in value:
-                self.sfs_2d.append(thesfs)
-                self.labels.append(key)
+        # one float32 tensor per pair of populations, with one SFS per dataset along the first axis
+        features, self.labels = stacked_features(sfs_2d, list)
+        self.sfs_2d = self._pair_tensors(features)
         self.nclasses = len(set(labels))
         if user:
             try:
@@ -94,37 +106,25 @@ class CnnSFS:
         except:
             pass
 
-    def build_cnn_sfs(self):
-
-        """Build a CNN that takes 2D SFS as input."""
+    def build_cnn_sfs(self, **training):
 
-        # get features
-        list_of_features = self._convert_2d_dictionary(self.sfs_2d)
+        """Build a CNN that takes 2D SFS as input. training are the options of
+        train_network."""
 
-        # shuffle data
+        # shuffle data, in place so that the training and validation sets are views
         num_samples = len(self.labels)
+        indices = np.random.permutation(num_samples)
+        for x in self.sfs_2d:
+            x[:] = x[indices]
+        self.labels = self.labels[indices]
 
-        # Create an array of indices and shuffle it
-        indices = np.arange(num_samples)
-        np.random.shuffle(indices)
-
-        # Split the shuffled indices into training and validation indices
+        # Split features and labels into training and validation sets
         split_ratio = 0.8  # 80% training, 20% validation
         split_idx = int(num_samples * split_ratio)
-        train_indices = indices[:split_idx]
-        val_indices = indices[split_idx:]
-
-        # Split features and labels into training and validation sets using the indices
-        train_features = [[list_of_features[j][i] for i in train_indices]\
-                          for j in range(len(list_of_features))]
-        val_features = [[list_of_features[j][i] for i in val_indices]\
-                        for j in range(len(list_of_features))]
-        train_labels = self.labels[train_indices]
-        val_labels = self.labels[val_indices]
-
-        # to arrays
-        train_features = [np.expand_dims(np.array(x), axis=-1) for x in train_features]
-        val_features = [np.expand_dims(np.array(x), axis=-1) for x in val_features]
+        train_features = [x[:split_idx] for x in self.sfs_2d]
+        val_features = [x[split_idx:] for x in self.sfs_2d]
+        train_labels = self.labels[:split_idx]
+        val_labels = self.labels[split_idx:]
 
         # build model
         my_layers = []
@@ -141,9 +141,8 @@ class CnnSFS:
         x = keras.layers.Dense(self.nclasses, activation='softmax')(x)
 
         model = keras.Model(inputs=inputs, outputs=x)
-        model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
-        model.fit(train_features, train_labels, epochs=10,
-                  batch_size=10, validation_data=(val_features, val_labels))
+        train_network(model, train_features, train_labels,
+                      validation_data=(val_features, val_labels), **training)
 
         val_pred = model.predict(val_features)
         val_predicted_labels = np.argmax(val_pred, axis=1)
@@ -154,8 +153,7 @@ class CnnSFS:
         return model, conf_matrix, conf_matrix_plot
 
     def predict(self, model, new_data):
-        new_features = self._convert_2d_dictionary(new_data)
-        new_features = [np.expand_dims(np.array(x), axis=-1) for x in new_features]
+        new_features = self._pair_tensors(new_data)
         predicted = model.predict(new_features)
         headers = ["Model {}".format(i) for i in range(predicted.shape[1])]
         replicate_numbers = ["Replicate {}".format(i+1) for i in range(predicted.shape[0])]
@@ -164,24 +162,27 @@ class CnnSFS:
 
         return(tabulated)
 
-    def _convert_2d_dictionary(self, data):
-
-        list_of_features = []
-
-        for data_dict in data:
+    def _pair_tensors(self, features):
 
-            count = 0
+        """One preallocated float32 tensor (datasets, n1+1, n2+1, 1) per pair of
+        populations. features is either a list of dictionaries of joint SFS keyed by
+        pair, one per dataset, or a list of arrays with the joint SFS of all datasets
+        along the first axis, one per pair (e.g. read from a TrainingData store)."""
 
-            for value in data_dict.values():
+        if len(features) and isinstance(features[0], dict):
+            tensors = [np.empty((len(features),) + np.shape(value) + (1,), dtype=np.float32) \
+                       for value in features[0].values()]
+            for i, data_dict in enumerate(features):
+                for tensor, value in zip(tensors, data_dict.values()):
+                    tensor[i, ..., 0] = value
+            return tensors
 
-                if len(list_of_features) >= count+1:
-                    list_of_features[count].append(np.array(value))
-                else:
-                    list_of_features.append([np.array(value)])
-
-                count+=1
-
-        return list_of_features
+        tensors = []
+        for x in features:
+            tensor = np.empty(np.shape(x) + (1,), dtype=np.float32)
+            tensor[..., 0] = x
+            tensors.append(tensor)
+        return tensors
 
 class NeuralNetSFS:
 
@@ -189,13 +190,9 @@ class NeuralNetSFS:
 
     def __init__(self, config, sfs, labels, user=False):
         self.config = config
-        self.sfs = []
-        self.labels = []
-        for key,value in sfs.items():
-            for thesfs in value:
-                self.sfs.append(thesfs)
-                self.labels.append(key)
-        self.sfs = np.array(self.sfs)
+        self.sfs, self.labels = stacked_features(sfs, stack)
+        if sparse.issparse(self.sfs):
+            self.sfs = self.sfs.toarray()
         self.nclasses = len(set(labels))
         if user:
             try:
@@ -212,10 +209,10 @@ class NeuralNetSFS:
             pass
 
 
-    def build_neuralnet_sfs(self):
+    def build_neuralnet_sfs(self, **training):
 
         """Build a neural network classifier that takes the
-        multidimensional SFS as input."""
+        multidimensional SFS as input. training are the options of train_network."""
 
         # split train and test
         train_test_seed = self.rng.integers(2**32, size=1)[0]
@@ -231,9 +228,7 @@ class NeuralNetSFS:
 
         # fit model
         model = keras.Model(inputs=network_input, outputs=x)
-        model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
-        model.fit(x_train, y_train, epochs=10,
-                  batch_size=10, validation_data=(x_test, y_test))
+        train_network(model, x_train, y_train, validation_data=(x_test, y_test), **training)
 
         # evaluate model
         val_pred = model.predict(x_test)
@@ -262,12 +257,7 @@ class CnnNpy:
 
     def __init__(self, config, arrays, labels, user=False):
         self.config = config
-        self.arrays = []
-        self.labels = []
-        for key,value in arrays.items():
-            for thearray in value:
-                self.arrays.append(thearray)
-                self.labels.append(key)
+        self.arrays, self.labels = stacked_features(arrays, np.array)
         self.nclasses = len(set(labels))
         if user:
             try:
@@ -283,9 +273,11 @@ class CnnNpy:
         except:
             pass
 
-    def build_cnn_npy(self):
+    def build_cnn_npy(self, batch_size=10, **training):
 
-        """Build a CNN that takes npy array as input."""
+        """Build a CNN that takes npy array as input. The alignments are read in batches,
+        as they are needed, so that memory is bounded by a few batches. training are
+        the other options of train_network."""
 
         # shuffle data
         num_samples = len(self.labels)
@@ -298,40 +290,23 @@ class CnnNpy:
         split_ratio = 0.8  # 80% training, 20% validation
         split_idx = int(num_samples * split_ratio)
         train_indices = indices[:split_idx]
-        val_indices = indices[split_idx:]
-
-        # Split features and labels into training and validation sets using the indices
-        train_features = np.array(self.arrays)[train_indices]
-        val_features = np.array(self.arrays)[val_indices]
-        train_features = np.expand_dims(np.array(train_features), axis=-1)
-        val_features = np.expand_dims(np.array(val_features), axis=-1)
+        val_indices = np.sort(indices[split_idx:])
 
-
-        train_labels = self.labels[train_indices]
-        val_labels = self.labels[val_indices]
-
-
-        # split by pop
-        split_train_features = []
-        split_val_features = []
-        start_idx = 0
-        for key, num_rows in self.config['sampling dict'].items():
-            end_idx = start_idx + num_rows
-            split_train_features.append(train_features[:,start_idx:end_idx,:,:])
-            split_val_features.append(val_features[:,start_idx:end_idx,:,:])
-            start_idx = end_idx
+        # stream batches of features and labels for training and validation
+        train_dataset = self._dataset(train_indices, batch_size, shuffle=True)
+        val_dataset = self._dataset(val_indices, batch_size)
 
         # build model
         input_layers = []
         output_layers = []
         for key,  num_rows in self.config['sampling dict'].items():
-            input_layer = keras.Input(shape=(num_rows, train_features.shape[2], 1), name=f'input_{key}')
+            input_layer = keras.Input(shape=(num_rows, self.arrays.shape[2], 1), name=f'input_{key}')
             input_layers.append(input_layer)
             conv_layer = keras.layers.Conv2D(10, (num_rows, 1), strides=(num_rows,1), activation="relu", padding="valid") (input_layer)
             output_layers.append(conv_layer)
 
         x = keras.layers.concatenate(output_layers, axis=1)
-        x = keras.layers.Conv2D(10, (len(split_train_features),1), activation="relu", padding="valid")(x)
+        x = keras.layers.Conv2D(10, (len(output_layers),1), activation="relu", padding="valid")(x)
         x = keras.layers.Flatten()(x)
         x = keras.layers.Dense(100, activation='relu')(x)
         x = keras.layers.Dropout(0.1)(x)
@@ -339,32 +314,33 @@ class CnnNpy:
         x = keras.layers.Dense(self.nclasses, activation='softmax')(x)
 
         model = keras.Model(inputs=input_layers, outputs=x)
-        model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
-        model.fit(split_train_features, train_labels, epochs=10,
-                  batch_size=10, validation_data=(split_val_features, val_labels))
+        train_network(model, train_dataset, validation_data=val_dataset, **training)
+        conf_matrix, conf_matrix_plot = self._validate(model, val_indices, batch_size)
+
+        return model, conf_matrix, conf_matrix_plot
+
+    def _validate(self, model, val_indices, batch_size):
 
-        val_pred = model.predict(split_val_features)
+        """Confusion matrix of the model on the alignments at val_indices. The alignments
+        are read, and so predicted, in the order they are stored, which is the order of
+        the true labels."""
+
+        val_indices = np.sort(val_indices)
+        val_pred = model.predict(self._dataset(val_indices, batch_size))
         val_predicted_labels = np.argmax(val_pred, axis=1)
-        val_true_labels = np.argmax(val_labels, axis=1)
+        val_true_labels = np.argmax(np.asarray(self.labels)[val_indices], axis=1)
         conf_matrix = confusion_matrix(val_true_labels, val_predicted_labels)
         conf_matrix_plot = plot_confusion_matrix(val_true_labels, val_predicted_labels)
 
-        return model, conf_matrix, conf_matrix_plot
+        return conf_matrix, conf_matrix_plot
 
     def predict(self, model, new_data):
  
         new_data = np.expand_dims(new_data, axis=-1)
         new_data = np.expand_dims(new_data, axis=0)
 
-
         # split by pop
-        split_features = []
-        start_idx = 0
-        for key, num_rows in self.config['sampling dict'].items():
-            end_idx = start_idx + num_rows
-            split_features.append(new_data[:,start_idx:end_idx,:,:])
-            start_idx = end_idx
-
+        split_features = self._split_populations(new_data)
 
         predicted = model.predict(split_features)
         headers = ["Model {}".format(i) for i in range(predicted.shape[1])]
@@ -374,7 +350,89 @@ class CnnNpy:
 
         return(tabulated)
 
+    def _split_populations(self, features):
+
+        """Split features (datasets, haplotypes, sites, 1) into one array per population."""
 
+        split_features = []
+        start_idx = 0
+        for key, num_rows in self.config['sampling dict'].items():
+            end_idx = start_idx + num_rows
+            split_features.append(features[:,start_idx:end_idx,:,:])
+            start_idx = end_idx
+        return split_features
+
+    def _dataset(self, indices, batch_size, shuffle=False):
+
+        """tf.data pipeline yielding batches of the alignments at indices, split by
+        population, with their labels. Each batch is read from the (possibly
+        memory-mapped) alignments when needed, and the next batches are prefetched.
+        With shuffle, the order of the alignments is drawn again at every epoch."""
+
+        labels = np.asarray(self.labels, dtype=np.float32)
+
+        def batches():
+            order = np.random.permutation(indices) if shuffle else indices
+            for start in range(0, len(order), batch_size):
+                # read the alignments of a batch in the order they are stored
+                batch = np.sort(order[start:start+batch_size])
+                features = np.asarray(self.arrays[batch], dtype=np.float32)[..., np.newaxis]
+                yield tuple(self._split_populations(features)), labels[batch]
+
+        signature = (tuple(tf.TensorSpec(shape=(None, num_rows, self.arrays.shape[2], 1), dtype=tf.float32) \
+                           for num_rows in self.config['sampling dict'].values()),
+                     tf.TensorSpec(shape=(None,) + labels.shape[1:], dtype=tf.float32))
+        return tf.data.Dataset.from_generator(batches, output_signature=signature).prefetch(2)
+
+
+def train_network(model, features, labels=None, validation_data=None, batch_size=10, epochs=10,
+                  patience=None, learning_rate=0.001, decay=None):
+
+    """Compile and fit a Keras classifier with Adam. features and labels are the training
+    data, or features is a tf.data.Dataset yielding batches of both, in which case
+    batch_size is not used; validation_data is given in the same way. With patience,
+    training stops once the validation loss has not improved for that many epochs, and
+    the weights of the best epoch are kept. With decay, the learning rate is multiplied
+    by decay after every epoch."""
+
+    callbacks = []
+    if patience is not None:
+        callbacks.append(keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience,
+                                                       restore_best_weights=True))
+    if decay is not None:
+        callbacks.append(keras.callbacks.LearningRateScheduler(
+            lambda epoch, lr: learning_rate * decay**epoch))
+
+    model.compile(optimizer=keras.optimizers.Adam(learning_rate=learning_rate),
+                  loss='categorical_crossentropy', metrics=['accuracy'])
+    if isinstance(features, tf.data.Dataset):
+        model.fit(features, epochs=epochs, validation_data=validation_data, callbacks=callbacks)
+    else:
+        model.fit(features, labels, epochs=epochs, batch_size=batch_size,
+                  validation_data=validation_data, callbacks=callbacks)
+    return model
+
+def set_threads(intra_op=0, inter_op=0):
+
+    """Set the number of threads TensorFlow uses within an operation and to run
+    operations in parallel (0 lets TensorFlow choose). Must be called before any model
+    is built."""
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+def stacked_features(data, stack_features):
+
+    """Features of all datasets stacked along the first axis, and the label of each
+    dataset. data is either a dictionary of lists of features keyed by label, whose
+    features are stacked with stack_features, or a tuple of features already stacked
+    and labels (e.g. read from a TrainingData store), which are used as they are."""
+
+    if isinstance(data, tuple):
+        features, labels = data
+        return features, list(labels)
+    labels = [key for key, values in data.items() for _ in values]
+    return stack_features([x for values in data.values() for x in values]), labels
 
 def plot_confusion_matrix(y_true, y_pred):
     conf_matrix = confusion_matrix(y_true, y_pred)
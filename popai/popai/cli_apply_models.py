@@ -4,7 +4,7 @@ import os
 import pickle
 import numpy as np
 from keras import models
-from popai import parse_input, build_predictors
+from popai import parse_input, build_predictors, sfs
 
 def main():
     parser = argparse.ArgumentParser(description='Command-line interface for my_package')
@@ -13,6 +13,7 @@ def main():
     parser.add_argument('--empirical', help='Path to directory with empirical SFS.')
     parser.add_argument('--output', help="Path to output folder for storing SFS.")
     parser.add_argument('--force', action='store_true', help='Overwrite existing results.')
+    parser.add_argument('--nbins', type=int, default=None, help='Number of bins for the mSFS, derived from the full-resolution mSFS saved with the empirical SFS (default: use the mSFS as written).')
     parser.add_argument('--rf', action='store_true', help='Apply RF classifier.')
     parser.add_argument('--fcnn', action='store_true', help='Apply FCNN classifier.')
     parser.add_argument('--cnn', action='store_true', help='Apply CNN classifier on jSFS.')
@@ -31,42 +32,21 @@ def main():
     config_values = config_parser.parse_config()
 
     # read empirical data into correct format
-    msfs_files = os.listdir(args.empirical)
-    msfs_files = [x for x in msfs_files if x.endswith('_DSFS.obs')]
-    msfs_files = sorted(msfs_files, key=lambda x: int(x.split('_')[0][3:]))
-    msfs = []
-    for file in msfs_files:
-        with open(os.path.join(args.empirical, file), 'r') as f:
-            lines = f.readlines()
-            this_sfs = lines[2].split(' ')
-            this_sfs = [int(x) for x in this_sfs]
-        msfs.append(this_sfs)
-    
-    jsfs = []
-    jsfs_files = os.listdir(args.empirical)
-    jsfs_files = [x for x in jsfs_files if x.endswith('.jsfs')]
-    populations = list(config_values["sampling dict"].keys())
-
-    for i in range(len(msfs)):
-        current_dict = {}
-        current_files = [x for x in jsfs_files if f"rep{i}" in x]
-        for i, pop1 in enumerate(populations):
-            for j, pop2 in enumerate(populations):
-                if i < j:
-                    target = [x for x in current_files if f"{pop1}_{pop2}_rep" in x]
-                    with open(os.path.join(args.empirical, target[0]), 'r') as f:
-                        next(f)
-                        next(f)
-                        data = []
-                        for line in f:
-                            values = line.strip().split()[1:]
-                            data.append([float(value) for value in values])
-                        array = np.array(data)
-                    current_dict[(pop1,pop2)] = array
-        jsfs.append(current_dict)
+    if os.path.exists(os.path.join(args.empirical, 'empirical_sfs.npz')):
+        pyramid_file = os.path.join(args.empirical, 'empirical_sfs.npz')
+        pyramid = sfs.SFSPyramid.load(pyramid_file)
+        nbins = args.nbins if args.nbins is not None else pyramid.nbins
+        cached = nbins is None or nbins in pyramid.levels
+        msfs = [list(x) for x in pyramid.level(nbins)]
+        jsfs = pyramid.joint_dicts()
+        if not cached:
+            # keep the derived level for later runs
+            pyramid.save(pyramid_file)
+    else:
+        if args.nbins is not None:
+            raise RuntimeError(f"Error: --nbins needs the full-resolution mSFS in empirical_sfs.npz, which is not in {args.empirical}. Please re-run process_empirical_data.")
+        msfs, jsfs = read_text_sfs(args.empirical, config_values)
 
-    empirical_array = np.load(os.path.join(args.empirical,"empirical.npy"))
-     
     if args.rf:
         # apply Random Forest model
         random_forest_sfs_predictor = build_predictors.RandomForestsSFS(config_values, {}, {})
@@ -96,10 +76,56 @@ def main():
         # apply FCNN model
         cnn_npy_predictor = build_predictors.CnnNpy(config_values, {}, {})
         cnn_npy_model = models.load_model(os.path.join(args.models, 'cnn_npy.keras'), compile=True)
-        results_cnn_npy = cnn_npy_predictor.predict(cnn_npy_model, empirical_array)
+        results_cnn_npy = cnn_npy_predictor.predict(cnn_npy_model, read_empirical_array(args.empirical))
         with open(os.path.join(args.output, 'cnn_npy_predictions.txt'), 'w') as f:
             f.write(results_cnn_npy)
 
+def read_empirical_array(empirical):
+
+    """Read the encoded empirical alignment, which process_empirical_data writes once to its
+    output directory when it builds the SFS of several downsamplings, each in a
+    subdirectory."""
+
+    for directory in (empirical, os.path.dirname(os.path.normpath(empirical))):
+        path = os.path.join(directory, "empirical.npy")
+        if os.path.exists(path):
+            return np.load(path)
+    raise FileNotFoundError(f"Error: no empirical.npy in {empirical} or its parent directory. Please re-run process_empirical_data.")
+
+def read_text_sfs(empirical, config_values):
+
+    """Read the mSFS and 2D SFS of every replicate from the text files written by older
+    versions of process_empirical_data (or with --text)."""
+
+    files = os.listdir(empirical)
+    msfs_files = sorted([x for x in files if x.endswith('_DSFS.obs')], key=lambda x: int(x.split('_')[0][3:]))
+    msfs = []
+    for file in msfs_files:
+        with open(os.path.join(empirical, file), 'r') as f:
+            lines = f.readlines()
+            this_sfs = lines[2].split(' ')
+            this_sfs = [float(x) for x in this_sfs]
+        msfs.append(this_sfs)
+
+    # jSFS files are named {pop1}_{pop2}_rep{i}.jsfs
+    jsfs_files = {x[:-len('.jsfs')]: x for x in files if x.endswith('.jsfs')}
+    populations = list(config_values["sampling dict"].keys())
+    jsfs = []
+    for replicate in range(len(msfs)):
+        current_dict = {}
+        for i, pop1 in enumerate(populations):
+            for j, pop2 in enumerate(populations):
+                if i < j:
+                    with open(os.path.join(empirical, jsfs_files[f"{pop1}_{pop2}_rep{replicate}"]), 'r') as f:
+                        next(f)
+                        next(f)
+                        data = []
+                        for line in f:
+                            values = line.strip().split()[1:]
+                            data.append([float(value) for value in values])
+                    current_dict[(pop1, pop2)] = np.array(data)
+        jsfs.append(current_dict)
+    return msfs, jsfs
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -3,26 +3,31 @@ import ast
 import os
 import pickle
 import numpy as np
-from popai import parse_input, process_empirical
+from popai import parse_input, process_empirical, sfs
 
 def main():
     parser = argparse.ArgumentParser(description='Command-line interface for processing empirical data.')
     parser.add_argument('--config', help='Path to config file.')
     parser.add_argument('--preview', action='store_true', help='Preview number of SNPs used for different down-projections')
-    parser.add_argument('--downsampling', help="Input downsampling dict as literal string (e.g., {'A': 10, 'B': 10, 'C': 5} to downsample to 10 individuals in populations A and B and 5 in population C).")
+    parser.add_argument('--downsampling', help="Input downsampling dict as literal string (e.g., {'A': 10, 'B': 10, 'C': 5} to downsample to 10 individuals in populations A and B and 5 in population C). A list of dicts, or a dict of lists of sizes (e.g., {'A': [8, 10], 'B': 10, 'C': [4, 6]}, for every combination), builds the SFS of each downsampling in one run, each in its own subdirectory of the output.")
     parser.add_argument('--reps', type=int, help="Number of replicate downsampled SFS to build.")
+    parser.add_argument('--projection', action='store_true', help="Build a single expected SFS by hypergeometric projection of every site to the downsampling, instead of --reps random subsamples.")
+    parser.add_argument('--marginal', action='store_true', help="Derive the 2D SFS by summing the mSFS over the other populations, instead of computing them separately.")
     parser.add_argument('--nbins', type=int, default=None, help='Number of bins for creating a binned SFS (default: None)')
     parser.add_argument('--output', help="Path to output folder for storing SFS.")
     parser.add_argument('--force', action='store_true', help='Overwrite existing results.')
+    parser.add_argument('--text', action='store_true', help="Also write the SFS of every replicate as text files (repN_DSFS.obs, and one .jsfs file per pair), besides empirical_sfs.npz.")
+    parser.add_argument('--cores', type=int, default=1, help="Number of cores to use when reading data, and processes for processing several downsamplings (default: 1).")
+    parser.add_argument('--cache', default=None, help="Directory for caching the encoded empirical data, so that repeated runs on the same data skip reading it; input files whose size or modification time changed are read again (default: no caching).")
 
     args = parser.parse_args()
     
     # Parse the configuration file
-    config_parser = parse_input.ModelConfigParser(args.config)
+    config_parser = parse_input.ModelConfigParser(args.config, cores=args.cores)
     config_values = config_parser.parse_config()
 
     # Process empirical data
-    data_processor = process_empirical.DataProcessor(config=config_values)
+    data_processor = process_empirical.DataProcessor(config=config_values, cores=args.cores, cache=args.cache)
     if "fastas" in config_values:
         empirical_array = data_processor.fasta_to_numpy()
     else:
@@ -36,48 +41,78 @@ def main():
     
     else:
         try:
-            downsampling_dict = ast.literal_eval(args.downsampling)
-        except ValueError:
+            downsamplings = process_empirical.expand_downsampling(ast.literal_eval(args.downsampling))
+        except (ValueError, SyntaxError):
             print('Error: Invalid downsampling dictionary. Please provide a valid dictionary string.')
             return
-    
-        empirical_2d_sfs = data_processor.numpy_to_2d_sfs(empirical_array, downsampling=downsampling_dict, replicates = args.reps)
-        empirical_msfs, average_snps = data_processor.numpy_to_msfs(empirical_array, downsampling=downsampling_dict, replicates = args.reps, nbins=args.nbins)
+
+        if args.projection:
+            args.reps = 1
 
         # check if output exists
         if os.path.exists(args.output) and not args.force:
             raise RuntimeError(f"Error: output directory, {args.output} already exists. Please specify a different directory, or use --force.")
 
+        # build the mSFS and the 2D SFS of every downsampling, each in a single pass over the data
+        if len(downsamplings) == 1:
+            results = [data_processor.numpy_to_sfs(empirical_array, downsampling=downsamplings[0], replicates = args.reps, projection=args.projection, marginal=args.marginal)]
+        else:
+            results = data_processor.numpy_to_sfs_grid(empirical_array, downsamplings=downsamplings, replicates = args.reps, projection=args.projection, marginal=args.marginal)
+
         # create output directory
         os.system('mkdir -p %s' % args.output)
 
         # save numpy array
         np.save(file=os.path.join(args.output, 'empirical.npy'), arr=empirical_array)
 
-        # make plots of empirical sfs
-        data_processor.plot_2dsfs(empirical_2d_sfs, output_directory=os.path.join(args.output))
+        # with several downsamplings, write each to its own subdirectory (e.g. A10_B10_C5)
+        for downsampling_dict, (empirical_msfs, empirical_2d_sfs, _) in zip(downsamplings, results):
+            output = args.output
+            if len(downsamplings) > 1:
+                output = os.path.join(args.output, '_'.join(f"{key}{downsampling_dict[key]}" for key in config_values['sampling dict']))
+                os.system('mkdir -p %s' % output)
+            write_sfs(output, config_values, downsampling_dict, empirical_msfs, empirical_2d_sfs, args.nbins, data_processor, text=args.text)
+
+def write_sfs(output, config_values, downsampling_dict, empirical_msfs, empirical_2d_sfs, nbins, data_processor, text=False):
+
+    """Write the mSFS and 2D SFS of every replicate of one downsampling to output, as a
+    single .npz file and, with text, also as one text file per replicate (and pair)."""
 
-        # save to output directory
-        for replicate in range(args.reps):
+    # keep the full-resolution mSFS, from which any binning can be derived later, with
+    # the 2D SFS of all replicates stacked per pair
+    layout = sfs.SFSLayout({key: downsampling_dict[key] for key in config_values['sampling dict']})
+    joint = [(key, np.stack([x[key] for x in empirical_2d_sfs])) for key in empirical_2d_sfs[0]]
+    pyramid = sfs.SFSPyramid(layout, empirical_msfs, joint=joint, nbins=nbins)
+    empirical_msfs = list(pyramid.level(nbins))
+    pyramid.save(os.path.join(output, 'empirical_sfs.npz'))
+
+    # make plots of empirical sfs
+    data_processor.plot_2dsfs(empirical_2d_sfs, output_directory=os.path.join(output))
+
+    if not text:
+        return
+
+    # save to output directory
+    for replicate in range(len(empirical_msfs)):
+
+        with open(os.path.join(output, f"rep{replicate}_DSFS.obs"), 'w') as f:
+            f.write("1 observations. No. of demes and sample sizes are on next line\n")
+            f.write(str(len(list(downsampling_dict.keys()))))
+            f.write(" ")
+            for key in config_values['sampling dict']:
+                f.write(f"{downsampling_dict[key]}")
+                f.write(" ")
+            f.write("\n")
+            f.write(' '.join(map(str, list(empirical_msfs[replicate]))))
 
-            with open(os.path.join(args.output, f"rep{replicate}_DSFS.obs"), 'w') as f:
-                f.write("1 observations. No. of demes and sample sizes are on next line\n")
-                f.write(str(len(list(downsampling_dict.keys()))))
+        for key, value in empirical_2d_sfs[replicate].items():
+            name = f"{key[0]}_{key[1]}_rep{replicate}.jsfs"
+            with open(os.path.join(output, name), 'w') as f:
+                f.write("1 observations\n")
                 f.write(" ")
-                for key in config_values['sampling dict']:
-                    f.write(f"{downsampling_dict[key]}")
-                    f.write(" ")
-                f.write("\n")
-                f.write(' '.join(map(str, list(empirical_msfs[replicate]))))
-
-            for key, value in empirical_2d_sfs[replicate].items():
-                name = f"{key[0]}_{key[1]}_rep{replicate}.jsfs"
-                with open(os.path.join(args.output, name), 'w') as f:
-                    f.write("1 observations\n")
-                    f.write(" ")
-                    f.write(' '.join([f'd_{i}' for i in range(value.shape[1])]) + '\n')
-                    for i in range(value.shape[0]):
-                        f.write(f'd_{i} ' + ' '.join(map(str, value[i])) + '\n')                    
+                f.write(' '.join([f'd_{i}' for i in range(value.shape[1])]) + '\n')
+                for i in range(value.shape[0]):
+                    f.write(f'd_{i} ' + ' '.join(map(str, value[i])) + '\n')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
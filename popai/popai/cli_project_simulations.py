@@ -0,0 +1,74 @@
+import argparse
+import ast
+import os
+import numpy as np
+from popai import parse_input, sfs, training_data, utils
+
+def main():
+    parser = argparse.ArgumentParser(description='Command-line interface for projecting simulated data to a smaller downsampling.')
+    parser.add_argument('--config', help='Path to config file.')
+    parser.add_argument('--simulations', help='Path to directory with data simulated at the full sample sizes (simulate_data --full).')
+    parser.add_argument('--downsampling', help="Input downsampling dict as literal string (e.g., {'A': 10, 'B': 10, 'C': 5} to downsample to 10 individuals in populations A and B and 5 in population C).")
+    parser.add_argument('--maxsites', type=int, default=None, help="Max number of SNPs of each projected dataset, as with simulate_data --maxsites; set it to the number of SNPs of the empirical data (default: keep all projected SNPs).")
+    parser.add_argument('--nbins', type=int, default=None, help='Number of bins for creating a binned SFS (default: None)')
+    parser.add_argument('--output', help="Path to output folder for storing SFS.")
+    parser.add_argument('--force', action='store_true', help='Overwrite existing results.')
+
+    args = parser.parse_args()
+
+    # check if output exists
+    if os.path.exists(args.output) and not args.force:
+        raise RuntimeError(f"Error: output directory, {args.output} already exists. Please specify a different directory, or use --force.")
+
+    # Parse the configuration file
+    config_parser = parse_input.ModelConfigParser(args.config)
+    config_values = config_parser.parse_config()
+
+    try:
+        downsampling_dict = ast.literal_eval(args.downsampling)
+        if not isinstance(downsampling_dict, dict):
+            raise ValueError
+    except (ValueError, SyntaxError):
+        print('Error: Invalid downsampling dictionary. Please provide a valid dictionary string.')
+        return
+    if not all(value % 2 == 0 for value in downsampling_dict.values()):
+        raise ValueError("Error in downampling, all keys must be even.")
+
+    # read the full-resolution mSFS of the simulations, kept with the training data
+    # when they were not binned
+    store = training_data.TrainingData(os.path.join(args.simulations, 'training_data'))
+    pyramid = sfs.SFSPyramid.load(os.path.join(args.simulations, 'simulated_msfs.npz'),
+                                  spectra=store.msfs() if 'msfs' in store else None)
+    if dict(pyramid.layout.downsampling) != dict(config_values['sampling dict']):
+        raise ValueError("Error: the simulations were not run at the full sample sizes. Please simulate them with simulate_data --full.")
+
+    # project the mSFS, and derive the 2D SFS from the projected mSFS; sites monomorphic
+    # in the subsamples are dropped, so the simulations need more SNPs than --maxsites
+    projected, layout = pyramid.layout.project(pyramid.spectra, downsampling_dict)
+    median_sites = int(np.ceil(np.median(projected.sum(axis=1))))
+    print(f"Projected datasets have a median of {median_sites} SNPs.")
+    if args.maxsites is not None:
+        if median_sites < args.maxsites:
+            print(f"Warning: fewer SNPs than --maxsites ({args.maxsites}) in most projected datasets. Please simulate more sites with simulate_data --full --maxsites.")
+        projected = sfs.limit_sites(projected, args.maxsites)
+    projected_pyramid = sfs.SFSPyramid(layout, projected, keys=pyramid.keys)
+    joint_sfs = layout.pairwise(projected)
+
+    # the alignments keep all haplotypes, as the CNN is applied to the full empirical
+    # alignment; only their number of sites is limited
+    arrays = store.arrays()
+    if args.maxsites is not None:
+        arrays = np.array([utils.limit_alignment_sites(array, args.maxsites) for array in arrays])
+
+    # create output directory
+    os.system('mkdir -p %s' % args.output)
+
+    # save these projected data.
+    training_data.TrainingData.write(os.path.join(args.output, 'training_data'), pyramid.keys,
+        msfs=projected_pyramid.level(args.nbins), jsfs=joint_sfs, arrays=arrays)
+    projected_pyramid.save(os.path.join(args.output, 'simulated_msfs.npz'), spectra=args.nbins is not None)
+    labels = np.load(os.path.join(args.simulations, 'labels.npy'), allow_pickle=True)
+    np.save(os.path.join(args.output, 'labels.npy'), labels, allow_pickle=True)
+
+if __name__ == '__main__':
+    main()
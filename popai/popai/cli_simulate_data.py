@@ -1,9 +1,8 @@
 import argparse
 import ast
 import os
-import pickle
 import numpy as np
-from popai import parse_input, generate_models, simulate_data, process_user_models
+from popai import parse_input, generate_models, simulate_data, process_user_models, sfs, training_data
 
 def main():
     parser = argparse.ArgumentParser(description='Command-line interface for my_package')
@@ -11,6 +10,9 @@ def main():
     parser.add_argument('--plot', action='store_true', help='Plot the popai models.')
     parser.add_argument('--simulate', action='store_true', help='Simulate data under the popai models.')
     parser.add_argument('--downsampling', help="Input downsampling dict as literal string (e.g., {'A': 10, 'B': 10, 'C': 5} to downsample to 10 individuals in populations A and B and 5 in population C).")
+    parser.add_argument('--marginal', action='store_true', help="Derive the 2D SFS by summing the mSFS over the other populations, instead of computing them from the simulated data.")
+    parser.add_argument('--sparse', action='store_true', help="Store the mSFS as sparse matrices, whose size depends on the number of SNPs rather than on the number of cells (recommended with many populations).")
+    parser.add_argument('--full', action='store_true', help="Simulate all sampled haplotypes, ignoring --downsampling, and store the mSFS sparse, so that the simulations can be projected to any downsampling with project_simulations.")
     parser.add_argument('--nbins', type=int, default=None, help='Number of bins for creating a binned SFSsimu (default: None)')
     parser.add_argument('--output', help="Path to output folder for storing SFS.")
     parser.add_argument('--force', action='store_true', help='Overwrite existing results.')
@@ -27,7 +29,7 @@ def main():
 
     
     # Parse the configuration file
-    config_parser = parse_input.ModelConfigParser(args.config)
+    config_parser = parse_input.ModelConfigParser(args.config, cores=args.cores)
     config_values = config_parser.parse_config()
 
     if config_values['user models'] is None:
@@ -45,7 +47,7 @@ def main():
         if args.simulate:
             # get dict for downsampling
             try:
-                downsampling_dict = ast.literal_eval(args.downsampling)
+                downsampling_dict = dict(config_values['sampling dict']) if args.full else ast.literal_eval(args.downsampling)
             except ValueError:
                 print('Error: Invalid downsampling dictionary. Please provide a valid dictionary string.')
                 return
@@ -67,7 +69,7 @@ def main():
         if args.simulate:
             # get dict for downsampling
             try:
-                downsampling_dict = ast.literal_eval(args.downsampling)
+                downsampling_dict = dict(config_values['sampling dict']) if args.full else ast.literal_eval(args.downsampling)
             except ValueError:
                 print('Error: Invalid downsampling dictionary. Please provide a valid dictionary string.')
                 return
@@ -80,18 +82,21 @@ def main():
     if args.simulate:
 
         # build SFS for simulate data
-        sfs_2d = data_simulator.mutations_to_2d_sfs(arrays)
-        msfs = data_simulator.mutations_to_sfs(arrays)
+        msfs = data_simulator.mutations_to_sfs(arrays, sparse=args.sparse or args.full)
+        if args.marginal:
+            sfs_2d = data_simulator.msfs_to_2d_sfs(msfs)
+        else:
+            sfs_2d = data_simulator.mutations_to_2d_sfs(arrays)
+
+        # keep the full-resolution mSFS, from which any binning can be derived later
+        pyramid = sfs.SFSPyramid.from_dict(data_simulator.layout, msfs)
 
         data_simulator.plot_2dsfs(sfs_2d,output_directory=args.output)
 
-        # save these simulated data.
-        with open(os.path.join(args.output, 'simulated_jsfs.pickle'), 'wb') as f:
-            pickle.dump(sfs_2d, f)
-        with open(os.path.join(args.output, 'simulated_arrays.pickle'), 'wb') as f:
-            pickle.dump(arrays, f)
-        with open(os.path.join(args.output, 'simulated_msfs.pickle'), 'wb') as f:
-            pickle.dump(msfs, f)
+        # save these simulated data, one memory-mappable array per feature type
+        training_data.TrainingData.from_dicts(os.path.join(args.output, 'training_data'), msfs=pyramid.to_dict(args.nbins), jsfs=sfs_2d, arrays=arrays)
+        # without binning, the full-resolution mSFS are those of the training data
+        pyramid.save(os.path.join(args.output, 'simulated_msfs.npz'), spectra=args.nbins is not None)
         np.save(os.path.join(args.output, 'labels.npy'), np.array(labels), allow_pickle=True)
 
 if __name__ == '__main__':
@@ -3,7 +3,7 @@ import ast
 import os
 import pickle
 import numpy as np
-from popai import parse_input, build_predictors
+from popai import parse_input, build_predictors, sfs, training_data
 
 def main():
     parser = argparse.ArgumentParser(description='Command-line interface for my_package')
@@ -15,7 +15,17 @@ def main():
     parser.add_argument('--fcnn', action='store_true', help='Train FCNN classifier.')
     parser.add_argument('--cnn', action='store_true', help='Train CNN classifier of SFS.')
     parser.add_argument('--cnnnpy', action='store_true', help='Train CNN classifier on alignments.')
+    parser.add_argument('--nbins', type=int, default=None, help='Number of bins for the mSFS, derived from the full-resolution mSFS saved with the simulations (default: use the mSFS as simulated).')
     parser.add_argument('--ntrees', type=int, help='Number of trees to use in the RF classifier (default=500).', default=500)
+    parser.add_argument('--batch', type=int, default=10, help='Batch size used to train the neural networks (default=10).')
+    parser.add_argument('--epochs', type=int, default=10, help='Maximum number of epochs used to train the neural networks (default=10).')
+    parser.add_argument('--patience', type=int, default=None, help='Stop training a neural network once the validation loss has not improved for this many epochs, keeping the best weights (default: train for all epochs).')
+    parser.add_argument('--lr', type=float, default=0.001, help='Initial learning rate of the neural networks (default=0.001).')
+    parser.add_argument('--decay', type=float, default=None, help='Factor by which the learning rate is multiplied after every epoch (default: constant learning rate).')
+    parser.add_argument('--maxsamples', type=float, default=None, help='Number of datasets (or fraction of the datasets, if at most 1) drawn to build each tree of the RF classifier (default: all).')
+    parser.add_argument('--maxmem', type=float, default=None, help='Maximum size of the RF classifier in MB, which bounds the number of leaves of each tree (default: no bound).')
+    parser.add_argument('--cores', type=int, default=0, help='Number of cores used to build the trees of the RF classifier, and threads TensorFlow uses within an operation (default: 0, all cores).')
+    parser.add_argument('--interop', type=int, default=0, help='Number of TensorFlow operations run in parallel (default: 0, let TensorFlow choose).')
 
     args = parser.parse_args()
 
@@ -29,26 +39,47 @@ def main():
     config_parser = parse_input.ModelConfigParser(args.config)
     config_values = config_parser.parse_config()
 
+    # threads must be set before TensorFlow runs anything
+    build_predictors.set_threads(args.cores, args.interop)
+    training = dict(batch_size=args.batch, epochs=args.epochs, patience=args.patience,
+                    learning_rate=args.lr, decay=args.decay)
+
     # set whether user
     if config_values['user models'] is None:
         user = False
     else:
         user = True
 
-    # read the data
+    # read the data; only the features used are read, memory-mapped
     labels = np.load(os.path.join(args.simulations, 'labels.npy'), allow_pickle=True)
-    
-    with open(os.path.join(args.simulations, 'simulated_msfs.pickle'), 'rb') as f:
-        msfs = pickle.load(f)
-    with open(os.path.join(args.simulations, 'simulated_jsfs.pickle'), 'rb') as f:
-        sfs_2d = pickle.load(f)
-    with open(os.path.join(args.simulations, 'simulated_arrays.pickle'), 'rb') as f:
-        array = pickle.load(f)
+    store = training_data.TrainingData(os.path.join(args.simulations, 'training_data'))
+    if not os.path.exists(store.directory):
+        # simulations written as pickles by older versions
+        msfs, sfs_2d, array = read_pickles(args.simulations, args.rf or args.fcnn, args.cnn, args.cnnnpy)
+    else:
+        dataset_labels = store.labels()
+        msfs = (store.msfs(), dataset_labels) if args.rf or args.fcnn else None
+        sfs_2d = (list(store.jsfs().values()), dataset_labels) if args.cnn else None
+        array = (store.arrays(), dataset_labels) if args.cnnnpy else None
+    if args.nbins is not None and (args.rf or args.fcnn):
+        pyramid_file = os.path.join(args.simulations, 'simulated_msfs.npz')
+        if not os.path.exists(pyramid_file):
+            # older simulations only have the mSFS as simulated, which may be binned
+            raise RuntimeError(f"Error: --nbins needs the full-resolution mSFS in simulated_msfs.npz, which is not in {args.simulations}. Please re-run simulate_data, or train without --nbins.")
+        # the full-resolution mSFS are those of the training data if not in the file
+        pyramid = sfs.SFSPyramid.load(pyramid_file, spectra=store.msfs() \
+            if os.path.exists(store.directory) and 'msfs' in store else None)
+        cached = args.nbins in pyramid.levels
+        msfs = (pyramid.level(args.nbins), np.array(pyramid.keys))
+        if not cached:
+            # keep the derived level for later runs
+            pyramid.save(pyramid_file)
 
     if args.rf:
         # train RF and save model and confusion matrix
         random_forest_sfs_predictor = build_predictors.RandomForestsSFS(config_values, msfs, labels, user=user)
-        random_forest_sfs_model, random_forest_sfs_cm, random_forest_sfs_cm_plot = random_forest_sfs_predictor.build_rf_sfs(ntrees=args.ntrees)
+        random_forest_sfs_model, random_forest_sfs_cm, random_forest_sfs_cm_plot = random_forest_sfs_predictor.build_rf_sfs(
+            ntrees=args.ntrees, cores=args.cores or -1, max_samples=args.maxsamples, max_memory=args.maxmem)
         with open(os.path.join(args.output, 'rf.model.pickle'), 'wb') as f:
             pickle.dump(random_forest_sfs_model, f)
         random_forest_sfs_cm_plot.savefig(os.path.join(args.output, 'rf_confusion.png'))
@@ -56,24 +87,37 @@ def main():
     if args.fcnn:
         # train FCNN and save model and confusion matrix
         neural_network_sfs_predictor = build_predictors.NeuralNetSFS(config_values, msfs, labels, user = user)
-        neural_network_sfs_model, neural_network_sfs_cm, neural_network_sfs_cm_plot = neural_network_sfs_predictor.build_neuralnet_sfs()
+        neural_network_sfs_model, neural_network_sfs_cm, neural_network_sfs_cm_plot = neural_network_sfs_predictor.build_neuralnet_sfs(**training)
         neural_network_sfs_model.save(os.path.join(args.output, 'fcnn.keras'))
         neural_network_sfs_cm_plot.savefig(os.path.join(args.output, 'fcnn_confusion.png'))
 
     if args.cnn:
         # train CNN and save model and confusion matrix
         cnn_2d_sfs_predictor = build_predictors.CnnSFS(config_values, sfs_2d, labels, user=user)
-        cnn_2d_sfs_model, cnn_2d_sfs_cm, cnn_2d_sfs_cm_plot = cnn_2d_sfs_predictor.build_cnn_sfs()
+        cnn_2d_sfs_model, cnn_2d_sfs_cm, cnn_2d_sfs_cm_plot = cnn_2d_sfs_predictor.build_cnn_sfs(**training)
         cnn_2d_sfs_model.save(os.path.join(args.output, 'cnn.keras'))
         cnn_2d_sfs_cm_plot.savefig(os.path.join(args.output, 'cnn_confusion.png'))
 
     if args.cnnnpy:
         # train CNN and save model and confusion matrix
         cnn_2d_npy_predictor = build_predictors.CnnNpy(config_values, array, labels, user=user)
-        cnn_2d_npy_model, cnn_2d_npy_cm, cnn_2d_npy_cm_plot = cnn_2d_npy_predictor.build_cnn_npy()
+        cnn_2d_npy_model, cnn_2d_npy_cm, cnn_2d_npy_cm_plot = cnn_2d_npy_predictor.build_cnn_npy(**training)
         cnn_2d_npy_model.save(os.path.join(args.output, 'cnn_npy.keras'))
         cnn_2d_npy_cm_plot.savefig(os.path.join(args.output, 'cnn_npy_confusion.png'))
 
+def read_pickles(simulations, msfs=True, jsfs=True, arrays=True):
+
+    """Read the simulated mSFS, 2D SFS and alignments that are used, from the pickles
+    written by older versions of simulate_data."""
+
+    data = []
+    for name, used in (('msfs', msfs), ('jsfs', jsfs), ('arrays', arrays)):
+        if used:
+            with open(os.path.join(simulations, f'simulated_{name}.pickle'), 'rb') as f:
+                data.append(pickle.load(f))
+        else:
+            data.append(None)
+    return data
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
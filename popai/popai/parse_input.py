@@ -1,8 +1,17 @@
 """This module contains all Classes for parsing user input."""
 
 import configparser # ModelConfigParser
+import gzip # VcfReader
+import io # VcfReader
+import itertools # VcfReader
+import mmap # FastaReader
 import os
+import re # VcfReader
+import struct # VcfReader
+import zlib # VcfReader
+from concurrent.futures import ThreadPoolExecutor # ModelConfigParser, VcfReader
 import dendropy # ModelConfigParser
+import numpy as np # FastaReader, VcfReader
 import pandas as pd # ModelConfigParser
 from collections import OrderedDict
 
@@ -10,8 +19,9 @@ class ModelConfigParser:
 
     """Parse user input from the configuration file."""
 
-    def __init__(self, configfile):
+    def __init__(self, configfile, cores=1):
         self.configfile = configfile
+        self.cores = cores
 
     def parse_config(self):
 
@@ -20,6 +30,7 @@ class ModelConfigParser:
 
         Parameters:
             configfile (str): Path to the configuration file.
+            cores (int): Number of threads used to read alignments.
 
         Returns:
             dict: A dictionary containing the parsed configuration values.
@@ -69,8 +80,12 @@ class ModelConfigParser:
             config_dict["substitution model"] = config["Simulations"]["substitution model"]
             config_dict["popfile"] = config["Data"]["popfile"]
             if config["Data"]["alignments"] == "None":
-                with open(config["Data"]["vcf"], 'r') as f:
-                    config_dict["vcf"] = f.readlines()
+                config_dict["vcf"] = config["Data"]["vcf"]
+                config_dict["regions"] = config["Data"].get("regions", "None")
+                if config_dict["regions"] == "None":
+                    config_dict["regions"] = None
+                else:
+                    config_dict["regions"] = [x.strip() for x in config_dict["regions"].split(",")]
             else:
                 config_dict["fasta folder"] = config["Data"]["alignments"]
         except KeyError as e:
@@ -104,25 +119,23 @@ class ModelConfigParser:
                 for key,value in config_dict["sampling dict"].items():
                     config_dict["sampling dict"][key] = value*2
 
-                # get lengths
-                lengths = [x for x in config_dict["vcf"] if "length" in x]
-                lengths = [int(x.split("=")[3].split(">")[0]) for x in lengths]
-                config_dict['lengths'] = lengths
-
-                # get individuals
-                individuals = [x for x in config_dict["vcf"] if x.startswith("#CHROM")][0]
-                individuals = set([x.strip() for x in individuals.split("\t") if x not in ("#CHROM","POS","ID","REF","ALT","QUAL","FILTER","INFO","FORMAT")])
+                # get lengths and individuals from the header only
+                vcf_header = VcfReader(config_dict["vcf"], regions=config_dict["regions"]).read_header()
+                config_dict['lengths'] = vcf_header['lengths']
+                individuals = set(vcf_header['samples'])
 
             else:
                 data_source = "alignment"
                 config_dict["population dictionary"] = config_dict["original population dictionary"]
 
-                # get fastas and lengths
-                fasta_list = os.listdir(config_dict["fasta folder"])
+                # get fastas, taxa and lengths, scanning files concurrently but keeping them
+                # sorted by name so that the column order does not depend on the file system;
+                # the sequences are only encoded when the data are processed
+                fasta_list = sorted(os.listdir(config_dict["fasta folder"]))
                 fasta_list = [x for x in fasta_list if x.endswith('.fa') or x.endswith('.fasta')]
-                config_dict['fastas'] = [dendropy.DnaCharacterMatrix.get(
-                    path=os.path.join(config_dict["fasta folder"], x), schema="fasta", \
-                        ) for x in fasta_list]
+                with ThreadPoolExecutor(max_workers=self.cores) as pool:
+                    config_dict['fastas'] = list(pool.map(lambda x: FastaReader(
+                        os.path.join(config_dict["fasta folder"], x)).scan(), fasta_list))
                 config_dict['lengths'] = [x.max_sequence_size for x in config_dict['fastas']]
 
                 # get number variable sites
@@ -169,6 +182,458 @@ class ModelConfigParser:
         which are all treated as missing."""
         individuals = []
         for item in fastas:
-            individuals.extend([str(x) for x in item.taxon_namespace])
-        individuals = [x.strip("'") for x in individuals]
+            individuals.extend(item.taxa)
         return set(individuals)
+
+
+class FastaReader:
+
+    """Read a fasta alignment as bytes and encode it as an int8 matrix
+    (A=0, T=1, C=2, G=3, anything else -1)."""
+
+    ENCODING = np.full(256, -1, dtype=np.int8)
+    ENCODING[list(b"ATCGatcg")] = [0, 1, 2, 3, 0, 1, 2, 3]
+    WHITESPACE = np.zeros(256, dtype=bool)
+    WHITESPACE[list(b" \t\r\n\v\f")] = True
+
+    def __init__(self, fastafile, mmap_size=2**26):
+        self.fastafile = fastafile
+        self.mmap_size = mmap_size
+        self.taxa = []
+        self.encoded = np.empty((0, 0), dtype=np.int8)
+        self.max_sequence_size = 0
+        self._rows = {}
+
+    def read(self):
+
+        """
+        Read and encode the alignment. Files of at least `mmap_size` bytes are memory-mapped
+        rather than read into memory.
+
+        Returns:
+            FastaReader: self, with taxon labels ('taxa') and an int8 matrix ('encoded') of
+                shape (taxa, max_sequence_size), where shorter sequences are padded with -1.
+        """
+
+        self._load(self._encode)
+        return self
+
+    def scan(self):
+
+        """
+        Read the taxon labels and sequence lengths of the alignment, without encoding it.
+
+        Returns:
+            FastaReader: self, with taxon labels ('taxa') and 'max_sequence_size' set.
+        """
+
+        self._load(self._scan)
+        return self
+
+    def _load(self, parse):
+        if not os.path.isfile(self.fastafile):
+            raise FileNotFoundError(f"The fasta file {self.fastafile} does not exist.")
+
+        with open(self.fastafile, 'rb') as f:
+            if self.mmap_size is not None and os.path.getsize(self.fastafile) >= self.mmap_size:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    parse(data)
+                finally:
+                    data.close()
+            else:
+                parse(f.read())
+
+    def __contains__(self, taxon):
+        return taxon in self._rows
+
+    def __getitem__(self, taxon):
+        return self.encoded[self._rows[taxon]]
+
+    def _records(self, data):
+
+        """Yield the label and the sequence bytes (whitespace removed) of every record."""
+
+        raw = np.frombuffer(data, dtype=np.uint8)
+
+        # records start with '>' at the start of a line
+        starts = np.flatnonzero(raw == ord('>'))
+        starts = starts[(starts == 0) | (raw[starts - 1] == ord('\n'))]
+        ends = np.append(starts[1:], raw.size)
+
+        for start, end in zip(starts, ends):
+            newline = start + np.argmax(raw[start:end] == ord('\n')) \
+                if np.any(raw[start:end] == ord('\n')) else end
+            sequence = raw[newline:end]
+            yield bytes(raw[start+1:newline]).decode().strip(), \
+                sequence[~self.WHITESPACE[sequence]]
+
+    def _scan(self, data):
+        taxa = []
+        sizes = []
+        for taxon, sequence in self._records(data):
+            taxa.append(taxon)
+            sizes.append(sequence.size)
+        self.taxa = taxa
+        self.max_sequence_size = max(sizes, default=0)
+
+    def _encode(self, data):
+        taxa = []
+        sequences = []
+        for taxon, sequence in self._records(data):
+            taxa.append(taxon)
+            sequences.append(self.ENCODING.take(sequence))
+
+        self.taxa = taxa
+        self.max_sequence_size = max([x.size for x in sequences], default=0)
+        self.encoded = np.full((len(sequences), self.max_sequence_size), -1, dtype=np.int8)
+        for i, sequence in enumerate(sequences):
+            self.encoded[i, :sequence.size] = sequence
+        self._rows = {taxon: i for i, taxon in enumerate(taxa)}
+
+
+class VcfReader:
+
+    """Stream diploid genotypes from a (optionally bgzip/gzip compressed) VCF file in blocks
+    of sites, optionally restricted to a list of regions."""
+
+    FIXED_COLUMNS = ("#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT")
+
+    def __init__(self, vcffile, chunksize=10000, regions=None, threads=1):
+        self.vcffile = vcffile
+        self.chunksize = chunksize
+        self.threads = threads
+        self.regions = None
+        if regions:
+            self.regions = [self._parse_region(x) for x in regions]
+
+    def read_header(self):
+
+        """
+        Read the meta-information lines and the column header of the VCF.
+
+        Returns:
+            dict: fragment lengths ('lengths'), one per contig or, when regions are given,
+                one per region, sample names in file order ('samples') and the index of the
+                FORMAT and sample columns ('columns').
+        """
+
+        if not os.path.isfile(self.vcffile):
+            raise FileNotFoundError(f"The vcf file {self.vcffile} does not exist.")
+
+        contigs = OrderedDict()
+        for line in self._iter_lines(header=True):
+            if line.startswith("#CHROM"):
+                columns = [x.strip() for x in line.split("\t")]
+                break
+            if line.startswith("##contig") and "length" in line:
+                contig_id = re.search(r"ID=([^,>]+)", line).group(1)
+                contigs[contig_id] = int(re.search(r"length=(\d+)", line).group(1))
+        else:
+            raise ValueError(f"Error in vcf: no #CHROM header line in {self.vcffile}.")
+
+        if self.regions is None:
+            lengths = list(contigs.values())
+        else:
+            lengths = []
+            for chrom, start, end in self.regions:
+                if end is not None:
+                    lengths.append(end - start + 1)
+                elif chrom in contigs:
+                    lengths.append(contigs[chrom])
+                else:
+                    raise ValueError(f"Error in vcf: no length for contig {chrom} in the header.")
+
+        samples = [x for x in columns if x not in self.FIXED_COLUMNS]
+        column_index = {x: i for i, x in enumerate(columns) if x}
+
+        return {'lengths': lengths, 'samples': samples, 'columns': column_index}
+
+    def iter_genotypes(self, samples):
+
+        """
+        Iterate over the VCF in blocks of at most `chunksize` sites.
+
+        Parameters:
+            samples (list): Sample names, in the order their haplotypes should appear.
+
+        Yields:
+            numpy.ndarray: int8 array of shape (2 * len(samples), sites in block), with the
+                two haplotypes of each sample on consecutive rows. Missing alleles and
+                genotypes with a depth of zero are encoded as -1.
+        """
+
+        header = self.read_header()
+        missing = [x for x in samples if x not in header['samples']]
+        if missing:
+            raise ValueError(f"Error in vcf: sample ids [{','.join(missing)}] not in vcf file.")
+        usecols = [header['columns']["FORMAT"]] + [header['columns'][x] for x in samples]
+
+        block = []
+        for line in self._iter_lines():
+            block.append(line)
+            if len(block) == self.chunksize:
+                yield self._parse_block(block, usecols)
+                block = []
+        if block:
+            yield self._parse_block(block, usecols)
+
+    def _parse_block(self, lines, usecols):
+        table = pd.read_csv(io.StringIO("".join(lines)), sep="\t", header=None, index_col=False,
+                            usecols=usecols, dtype=str, na_filter=False)
+        table = table[usecols].to_numpy()
+        return self._decode_block(table[:, 0], table[:, 1:])
+
+    def _iter_lines(self, header=False):
+
+        """Yield header lines (header=True) or the data lines of the requested regions."""
+
+        if header:
+            for line in self._open_lines():
+                if not line.startswith("#"):
+                    break
+                yield line
+            return
+
+        if self.regions is None:
+            for line in self._open_lines():
+                if not line.startswith("#"):
+                    yield line
+            return
+
+        index = self._read_tabix_index()
+        if index is None:
+            # no index, scan the whole file
+            for line in self._open_lines():
+                if not line.startswith("#") and \
+                        any(self._region_status(line, region) == 0 for region in self.regions):
+                    yield line
+            return
+
+        # seek to the first block that may overlap each region, stop once past it;
+        # regions are visited in file order so that sites come out as they would in a scan
+        contig_order = list(index.keys())
+        regions = sorted([x for x in self.regions if x[0] in index],
+                         key=lambda x: (contig_order.index(x[0]), x[1]))
+        for region in self._merge_regions(regions):
+            chrom, start, _ = region
+            for line in self._open_lines(voffset=self._region_offset(index[chrom], start)):
+                if line.startswith("#"):
+                    continue
+                status = self._region_status(line, region)
+                if status == 0:
+                    yield line
+                elif status == 1:
+                    break
+
+    def _open_lines(self, voffset=0):
+
+        """Yield lines from the start of the file, or from a bgzf virtual offset."""
+
+        with open(self.vcffile, 'rb') as f:
+            magic = f.read(18)
+        if magic[:2] != b"\x1f\x8b":
+            with open(self.vcffile, 'r') as f:
+                yield from f
+        elif len(magic) == 18 and magic[3] & 4 and magic[12:14] == b"BC":
+            with open(self.vcffile, 'rb') as f:
+                f.seek(voffset >> 16)
+                for line in _iter_bgzf_lines(f, self.threads, skip=voffset & 0xFFFF):
+                    yield line.decode()
+        else:
+            with gzip.open(self.vcffile, 'rt') as f:
+                yield from f
+
+    def _read_tabix_index(self):
+
+        """Read the linear index of a tabix (.tbi) index, if there is one."""
+
+        tbi = f"{self.vcffile}.tbi"
+        if not os.path.isfile(tbi):
+            return None
+        with gzip.open(tbi, 'rb') as f:
+            data = f.read()
+        if data[:4] != b"TBI\x01":
+            raise ValueError(f"Error in vcf index: {tbi} is not a tabix index.")
+        n_ref = struct.unpack_from("<i", data, 4)[0]
+        l_nm = struct.unpack_from("<i", data, 32)[0]
+        names = data[36:36+l_nm].split(b"\x00")[:n_ref]
+        offset = 36 + l_nm
+        index = {}
+        for name in names:
+            n_bin = struct.unpack_from("<i", data, offset)[0]
+            offset += 4
+            first = None
+            for _ in range(n_bin):
+                bin_id, n_chunk = struct.unpack_from("<Ii", data, offset)
+                offset += 8
+                chunks = struct.unpack_from(f"<{2*n_chunk}Q", data, offset)
+                offset += 16 * n_chunk
+                # bin 37450 holds summary statistics rather than offsets
+                if bin_id != 37450 and n_chunk and (first is None or min(chunks[::2]) < first):
+                    first = min(chunks[::2])
+            n_intv = struct.unpack_from("<i", data, offset)[0]
+            offset += 4
+            linear = struct.unpack_from(f"<{n_intv}Q", data, offset)
+            offset += 8 * n_intv
+            index[name.decode()] = (first or 0, linear)
+        return index
+
+    def _region_offset(self, contig_index, start):
+        first, linear = contig_index
+        window = (start - 1) >> 14
+        if window < len(linear) and linear[window] > first:
+            return linear[window]
+        return first
+
+    def _merge_regions(self, regions):
+
+        """Merge overlapping or adjacent regions, sorted by contig and start, so that each
+        site is read once."""
+
+        merged = []
+        for chrom, start, end in regions:
+            if merged and merged[-1][0] == chrom and \
+                    (merged[-1][2] is None or start <= merged[-1][2] + 1):
+                last_end = merged[-1][2]
+                merged[-1] = (chrom, merged[-1][1], None if last_end is None or end is None \
+                              else max(last_end, end))
+            else:
+                merged.append((chrom, start, end))
+        return merged
+
+    def _region_status(self, line, region):
+
+        """Return -1 if a data line precedes the region, 0 if it is inside it and 1 if it
+        is past it (same contig, after the end) or on another contig."""
+
+        chrom, start, end = region
+        fields = line.split("\t", 2)
+        if fields[0] != chrom:
+            return 1
+        position = int(fields[1])
+        if position < start:
+            return -1
+        if end is not None and position > end:
+            return 1
+        return 0
+
+    def _parse_region(self, region):
+        region = region.strip()
+        match = re.fullmatch(r"(.+):(\d+)-(\d+)", region)
+        if match:
+            start, end = int(match.group(2)), int(match.group(3))
+            if start < 1 or end < start:
+                raise ValueError(f"Error in region {region}: invalid coordinates.")
+            return (match.group(1), start, end)
+        return (region, 1, None)
+
+    def _decode_block(self, formats, fields):
+
+        """Decode the GT and DP subfields of a (sites, samples) block of genotype fields."""
+
+        nsites, nsamples = fields.shape
+
+        # single digit alleles are at positions 0 and 2 of the GT subfield, so only the
+        # first four characters of each field are viewed as a (sites, samples, 4) byte array
+        chars = np.ascontiguousarray(np.asarray(fields, dtype='S4')).view(np.uint8).reshape(
+            nsites, nsamples, 4)
+        separator = ((chars[:, :, 1] == ord('|')) | (chars[:, :, 1] == ord('/'))) & \
+            ((chars[:, :, 3] == ord(':')) | (chars[:, :, 3] == 0))
+        alleles = np.stack([chars[:, :, 0], chars[:, :, 2]], axis=-1).astype(np.int16)
+        is_dot = alleles == ord('.')
+        alleles -= ord('0')
+        single_digit = separator & np.all(((alleles >= 0) & (alleles <= 9)) | is_dot, axis=-1)
+        alleles[is_dot] = -1
+        alleles = alleles.astype(np.int8)
+
+        # anything else (multi-digit alleles, '.', './.', ...) is decoded field by field
+        for site, sample in zip(*np.nonzero(~single_digit)):
+            alleles[site, sample] = self._decode_gt(fields[site, sample])
+
+        # genotypes with a depth of zero are missing
+        dp_position = np.full(nsites, -1, dtype=np.int8)
+        for this_format in set(formats):
+            subfields = this_format.split(":")
+            if "DP" in subfields:
+                dp_position[formats == this_format] = subfields.index("DP")
+        alleles[self._dp_zero(fields, dp_position)] = -1
+
+        # (sites, samples, 2) -> (haplotypes, sites)
+        return alleles.transpose(1, 2, 0).reshape(2 * nsamples, nsites)
+
+    def _dp_zero(self, fields, dp_position, max_bytes=2**24):
+
+        """Mask of the genotype fields whose DP subfield (at dp_position in the FORMAT of
+        each site, -1 if absent) is 0. Whole fields are viewed as bytes, and can be long
+        (e.g. with AD and PL subfields), so they are decoded for groups of samples holding
+        at most about max_bytes bytes."""
+
+        dp_zero = np.zeros(fields.shape, dtype=bool)
+        sites = np.flatnonzero(dp_position >= 0)
+        if not sites.size:
+            return dp_zero
+        fields = fields[sites]
+        dp_position = dp_position[sites, None, None]
+        width = max(map(len, fields.ravel()))
+        group = max(1, max_bytes // (len(sites) * max(width, 1)))
+        for start in range(0, fields.shape[1], group):
+            subset = np.asarray(fields[:, start:start+group], dtype='S')
+            chars = subset.view(np.uint8).reshape(subset.shape + (subset.dtype.itemsize,))
+            is_colon = chars == ord(':')
+            in_dp = (np.cumsum(is_colon, axis=-1, dtype=np.int8) == dp_position) & \
+                ~is_colon & (chars != 0)
+            dp_zero[sites, start:start+group] = (np.sum(in_dp, axis=-1) == 1) & \
+                np.any(in_dp & (chars == ord('0')), axis=-1)
+        return dp_zero
+
+    def _decode_gt(self, field):
+        gt = field.split(":")[0]
+        if gt == ".":
+            return [-1, -1]
+        values = re.split(r"[|/]", gt)
+        if len(values) != 2:
+            raise ValueError(f"Error in vcf: expected a diploid genotype but found {gt}.")
+        return [-1 if x == "." else int(x) for x in values]
+
+
+def _iter_bgzf_lines(handle, threads=1, skip=0):
+
+    """Yield lines from a bgzf stream, inflating blocks in parallel on `threads` threads.
+    The first `skip` decompressed bytes are discarded."""
+
+    def read_blocks():
+        while True:
+            header = handle.read(12)
+            if len(header) < 12:
+                return
+            xlen = struct.unpack("<H", header[10:12])[0]
+            extra = handle.read(xlen)
+            bsize = None
+            position = 0
+            while position < xlen:
+                subfield, length = extra[position:position+2], struct.unpack(
+                    "<H", extra[position+2:position+4])[0]
+                if subfield == b"BC":
+                    bsize = struct.unpack("<H", extra[position+4:position+6])[0]
+                position += 4 + length
+            if bsize is None:
+                raise ValueError("Error in vcf: not a valid bgzf block.")
+            yield handle.read(bsize - xlen - 11)[:-8]
+
+    remainder = b""
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        blocks = read_blocks()
+        while True:
+            batch = list(itertools.islice(blocks, 16 * threads))
+            if not batch:
+                break
+            for data in pool.map(lambda x: zlib.decompress(x, -15), batch):
+                if skip:
+                    data, skip = data[skip:], max(skip - len(data), 0)
+                lines = (remainder + data).split(b"\n")
+                remainder = lines.pop()
+                for line in lines:
+                    yield line + b"\n"
+    if remainder:
+        yield remainder
@@ -1,21 +1,30 @@
 """This module contains the Class for processing empirical data."""
 import logging
 import itertools
-from collections import Counter, OrderedDict
-from itertools import product
+from collections import OrderedDict
 import copy
+import hashlib
+import multiprocessing
 import os
-import io
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
-import pandas as pd
-from popai.utils import minor_encoding
+from popai.parse_input import FastaReader, VcfReader
+from popai.sfs import SFSLayout, expected_spectrum, fold_pair
+from popai.utils import hypergeometric_pmf, minor_encoding, remove_invariant_sites
 class DataProcessor:
 
     """Process empirical data."""
 
-    def __init__(self, config):
+    CACHE_VERSION = 2
+
+    def __init__(self, config, cores=1, cache=None, block_size=100000):
         self.config = config
+        self.cores = cores
+        self.cache = cache
+        self.block_size = block_size
 
         # Configure logging
         logging.basicConfig(level=logging.INFO)
@@ -28,46 +37,32 @@ class DataProcessor:
 
         """Convert a list of fasta files into a numpy array."""
 
-        # dictionary for encoding
-        integer_encoding_dict = {"A": 0, "T": 1, "C": 2, "G": 3}
-
-        # list for storing results
-        encoded_alignments = []
-
-        # iterate over populations and create ordered numpy array
+        # get all samples, ordered by population/species
+        samples = []
         for population in self.config["sampling dict"].keys():
-
-            # get all samples from that population/species
-            samples_from_population = [key for key, value in \
-                self.config["population dictionary"].items() if value == population]
-
-            for item in samples_from_population:
-
-                encoded_string = []
-
-                for alignment in self.config["fastas"]:
-                    if item in alignment:
-                        encoded_string_current = np.array(self._encode_string(
-                            string=str(alignment[item]), encoding_dict=integer_encoding_dict))
-                    else:
-                        encoded_string_current = [-1]*alignment.max_sequence_size
-
-                    encoded_string.extend(encoded_string_current)
-
-                encoded_alignments.append(encoded_string)
-
-        # convert to numpy array
-        encoded_alignments = np.array(encoded_alignments)
-
-        # remove invariable columns
-        frequencies = np.array([[np.sum(encoded_alignments[:, j] == i) \
-            for i in range(0, 4)] for j in range(encoded_alignments.shape[1])])
-        invariant_columns = np.where(np.sum(frequencies == 0, axis=1) >= 3)[0]
-        filtered_alignments = np.delete(encoded_alignments, invariant_columns, axis=1)
-
-        # concert to minor allele encoding
-        encoded_array = minor_encoding(filtered_alignments)
-
+            samples.extend([key for key, value in \
+                self.config["population dictionary"].items() if value == population])
+
+        cache_file = self._cache_file("fasta", [x.fastafile for x in self.config["fastas"]], samples)
+        if cache_file is not None and os.path.isfile(cache_file):
+            return self._load_cache(cache_file)
+
+        # each locus is read, filtered and encoded on its own, concurrently, and the
+        # results are appended in locus order; samples missing from an alignment
+        # are coded as missing (-1)
+        def encode_alignment(alignment):
+            alignment = FastaReader(alignment.fastafile, alignment.mmap_size).read()
+            locus = np.full((len(samples), alignment.max_sequence_size), -1, dtype=np.int8)
+            for row, item in enumerate(samples):
+                if item in alignment:
+                    locus[row] = alignment[item]
+            return minor_encoding(remove_invariant_sites(locus))
+
+        writer = _ColumnWriter(len(samples), cache_file)
+        with ThreadPoolExecutor(max_workers=self.cores) as pool:
+            for block in pool.map(encode_alignment, self.config["fastas"]):
+                writer.append(block)
+        encoded_array = writer.finish()
 
         self.logger.info("""Empirical data has %s SNPs. If this is very different than the number of SNPs in your simulated data, you may want to change some priors.""",
                          encoded_array.shape[1])
@@ -76,198 +71,162 @@ class DataProcessor:
 
     def vcf_to_numpy(self):
 
-        """Convert VCF to numpy array."""
+        """Convert VCF to numpy array, streaming the file in blocks of sites."""
 
-        # vcf to table
-        start_index = [i for i, item in enumerate(self.config['vcf']) if 'CHROM' in item][0]
-        relevant_lines = '\n'.join(self.config['vcf'][start_index:])
-        vcf_table = pd.read_csv(io.StringIO(relevant_lines), sep="\t", index_col=False)
+        # get all samples, ordered by population/species
+        samples = []
+        for population in self.config['sampling dict'].keys():
+            samples.extend([key for key, value in \
+                self.config["original population dictionary"].items() if value == population])
+
+        cache_file = self._cache_file("vcf", [self.config['vcf']], samples,
+                                      self.config.get('regions'))
+        if cache_file is not None and os.path.isfile(cache_file):
+            return self._load_cache(cache_file)
+
+        # filter and encode the file block by block, the result being written straight
+        # to disk (the cache, or a temporary file) so the matrix is never held in memory
+        reader = VcfReader(self.config['vcf'], regions=self.config.get('regions'),
+                           threads=self.cores)
+        writer = _ColumnWriter(2*len(samples), cache_file)
+        for block in reader.iter_genotypes(samples):
+            writer.append(minor_encoding(remove_invariant_sites(block)))
+        encoded_array = writer.finish()
 
-        # get DP index
-        format_lines = [x for x in self.config['vcf'] if 'FORMAT' in x]
-        dp_index = [i for i, item in enumerate(format_lines) if 'DP' in item][0]
+        self.logger.info("Empirical data has %s SNPs. If this is very different than the number of SNPs in your simulated data, you may want to change some priors.", encoded_array.shape[1])
 
-        encoded_alignments = []
-        for population in self.config['sampling dict'].keys():
+        return encoded_array
 
-            # get all samples for that poulation/species
-            samples_from_population = [key for key, value in \
-                self.config["original population dictionary"].items() if value == population]
+    def _cache_file(self, source, paths, samples, options=None):
 
-            for item in samples_from_population:
+        """Path of the cached encoded matrix for these inputs, keyed by a hash of the
+        path, size and modification time of the input files and the popfile, and of the
+        encoding options, so that the inputs need not be read. None if caching is off."""
 
-                encoded_string_1 = []
-                encoded_string_2 = []
+        if self.cache is None:
+            return None
 
-                info = vcf_table[item]
+        files = []
+        for path in [self.config["popfile"]] + list(paths):
+            stat = os.stat(path)
+            files.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+        key = hashlib.blake2b(digest_size=20)
+        key.update(repr((self.CACHE_VERSION, source, samples, options, files)).encode())
 
-                for row in info:
-                    value1 = row.split("|")[0]
-                    value2 = row.split("|")[1].split(":")[0]
-                    dp = row.split(":")[dp_index]
+        return os.path.join(self.cache, f"{source}_{key.hexdigest()}.npy")
 
-                    if (value1 != "." or value2 != ".") and dp != '0':
+    def _load_cache(self, cache_file):
+        encoded_array = np.load(cache_file, mmap_mode='r')
+        self.logger.info("Read encoded empirical data with %s SNPs from cache %s.",
+                         encoded_array.shape[1], cache_file)
+        return encoded_array
 
-                        encoded_string_1.append(int(value1))
-                        encoded_string_2.append(int(value2))
+    def _iter_blocks(self, encoded_alignment):
 
-                    else:
-                        encoded_string_1.append(-1)
-                        encoded_string_2.append(-1)
+        """Yield blocks of at most `block_size` sites."""
 
-                encoded_alignments.append(encoded_string_1)
-                encoded_alignments.append(encoded_string_2)
+        for start in range(0, encoded_alignment.shape[1], self.block_size):
+            yield np.asarray(encoded_alignment[:, start:start+self.block_size])
 
-        encoded_alignments = np.array(encoded_alignments)
+    def count_sites(self, encoded_alignment):
 
-        # remove invariable columns
-        frequencies = np.array([[np.sum(encoded_alignments[:, j] == i) \
-            for i in range(0, 4)] for j in range(encoded_alignments.shape[1])])
-        invariant_columns = np.where(np.sum(frequencies == 0, axis=1) >= 3)[0]
-        filtered_alignments = np.delete(encoded_alignments, invariant_columns, axis=1)
+        """Per-population numbers of non-missing haplotypes and of minor alleles (1) at each
+        biallelic site, as two arrays with one row per population. These counts are all
+        the SFS are built from, and can be passed to numpy_to_sfs in place of the
+        alignment, to build the SFS of several downsamplings without reading it again."""
 
-        encoded_array = minor_encoding(filtered_alignments)
+        present = [np.empty((len(self.config['sampling dict']), 0), dtype=np.int64)]
+        minor = [present[0]]
+        for block in self._iter_blocks(encoded_alignment):
+            block_present, block_minor, biallelic = self._site_counts(block)
+            present.append(block_present[:, biallelic])
+            minor.append(block_minor[:, biallelic])
+        dtype = np.min_scalar_type(max(self.config['sampling dict'].values()))
+        return np.concatenate(present, axis=1).astype(dtype), \
+            np.concatenate(minor, axis=1).astype(dtype)
 
+    def _iter_counts(self, encoded_alignment, downsampling):
 
-        self.logger.info("Empirical data has %s SNPs. If this is very different than the number of SNPs in your simulated data, you may want to change some priors.", encoded_array.shape[1])
+        """Yield, block by block, the per-population numbers of non-missing haplotypes and
+        of minor alleles of the biallelic sites with enough data in every population for
+        the downsampling. encoded_alignment is either an alignment or the counts returned
+        by count_sites."""
 
-        return encoded_array
+        if isinstance(encoded_alignment, tuple):
+            all_present, all_minor = encoded_alignment
+            blocks = ((all_present[:, start:start+self.block_size], all_minor[:, start:start+self.block_size]) \
+                      for start in range(0, all_present.shape[1], self.block_size))
+        else:
+            blocks = ((present[:, biallelic], minor[:, biallelic]) for present, minor, biallelic \
+                      in map(self._site_counts, self._iter_blocks(encoded_alignment)))
 
-    def _encode_string(self, string, encoding_dict):
-        encoded_string = []
-        for char in string:
-            if char in encoding_dict:
-                encoded_string.append(encoding_dict[char])
-            else:
-                encoded_string.append(-1)
-        return encoded_string
+        sizes = np.array([downsampling[name] for name in self.config['sampling dict']])[:, None]
+        for present, minor in blocks:
+            enough = np.all(present >= sizes, axis=0)
+            yield present[:, enough].astype(np.int64), minor[:, enough].astype(np.int64)
 
     def find_downsampling(self, encoded_alignment):
         """This funciton will convert an empirical alignment to a site frequency spectrum.
         It needs to deal with missing data in an intelligent way (e.g., downsampling)."""
 
-        sampled = 0
-        pop_failure_masks = []
-
-        for population in self.config['sampling dict'].values():
-            this_array = encoded_alignment[sampled:sampled+population,:]
-            mask = this_array == -1
-            count_minus_ones = np.sum(mask, axis=0)
-            failure_masks = {population-j: (count_minus_ones <= j) \
-                             for j in range(population)}
-            pop_failure_masks.append(failure_masks)
-            sampled += population
-        all_combinations = itertools.product(*pop_failure_masks)
-        results = {}
-        for thresholds in all_combinations:
-            if all(value % 2 == 0 for value in thresholds):
-                thethresholds = [pop_failure_masks[j][thresholds[j]] \
-                                 for j in range(len(pop_failure_masks))]
-                combined_mask = np.logical_and.reduce(thethresholds)
-                results[thresholds] = np.sum(combined_mask)
-        results = {key: value for key, value in results.items() if value != 0}
+        # histogram of sites over the number of (pairs of) non-missing haplotypes
+        # per population; only even thresholds are reported, so c and c+1
+        # non-missing haplotypes can share a bin
+        shape = tuple(population // 2 + 1 for population in self.config['sampling dict'].values())
+        histogram = np.zeros(int(np.prod(shape)), dtype=np.int64)
+        for block in self._iter_blocks(encoded_alignment):
+            sampled = 0
+            pairs_present = []
+            for population in self.config['sampling dict'].values():
+                count_present = np.sum(block[sampled:sampled+population, :] != -1, axis=0)
+                pairs_present.append(count_present // 2)
+                sampled += population
+            histogram += np.bincount(np.ravel_multi_index(pairs_present, shape),
+                                     minlength=histogram.size)
+
+        # sites with at least the threshold in every population: suffix sums along each axis
+        histogram = histogram.reshape(shape)
+        for axis in range(histogram.ndim):
+            histogram = np.flip(np.cumsum(np.flip(histogram, axis), axis=axis), axis)
+
+        # report even thresholds, in decreasing order per population, with any sites
+        thresholds = [[population-j for j in range(population) if (population-j) % 2 == 0] \
+                      for population in self.config['sampling dict'].values()]
+        counts = histogram[np.ix_(*[[x // 2 for x in values] for values in thresholds])]
+        nonzero = np.nonzero(counts)
+        keys = np.column_stack([np.array(values, dtype=int)[index] \
+                                for values, index in zip(thresholds, nonzero)])
+        results = dict(zip(map(tuple, keys.tolist()), counts[nonzero]))
 
         return results
 
-    def numpy_to_2d_sfs(self, encoded_alignment, downsampling, replicates = 1):
+    def numpy_to_2d_sfs(self, encoded_alignment, downsampling, replicates = 1, projection=False):
 
-        """Convert numpy array to 2d SFS."""
+        """Convert numpy array to 2d SFS. With projection=True, return a single expected
+        SFS obtained by hypergeometric projection of each site to the downsampling,
+        instead of random subsampling replicates."""
 
         # check that using even values
         key_even = all(value % 2 == 0 for value in downsampling.values())
         if not key_even:
             raise ValueError("Error in downampling, all keys must be even.")
 
-        # get indices for samples
-        current = 0
-        sampling_indices = {}
-        for key, value in self.config["sampling dict"].items():
-            sampling_indices[key] = [current, value + current]
-            current = current+value
-
-        # remove columns that do not meet thresholds
-        sampled = 0
-        pop_failure_masks = []
-        for name, population in self.config["sampling dict"].items():
-            this_array = encoded_alignment[sampled:sampled+population,:]
-            mask = this_array==-1
-            count_minus_ones = np.sum(mask, axis=0)
-            failure_mask = count_minus_ones <= population - downsampling[name]
-            pop_failure_masks.append(failure_mask)
-            sampled += population
-        combined_mask = np.logical_and.reduce(pop_failure_masks)
-        filtered_encoded_alignment = encoded_alignment[:,combined_mask]
-
         # create empty sfs
-        # iterate over each pair of populations
-        populations = list(self.config["sampling dict"].keys())
-        sfs_2d = {}
-        sfs_list = []
-        for i, pop1 in enumerate(populations):
-            for j, pop2 in enumerate(populations):
-                if i < j:
-                    # create an empty 2D numpy array with the correct shape
-                    array_shape = (downsampling[pop1]+1, downsampling[pop2]+1)
-                    sfs_2d[(pop1, pop2)] = np.zeros(array_shape)
+        sfs_2d = self._empty_2d_sfs(downsampling)
+
+        if projection:
+            pmfs, weights = self._projection_pmfs(encoded_alignment, downsampling)
+            return [self._project_2d_sfs(pmfs, weights, sfs_2d)]
 
         # conver to list of sfs, one per replicate
         sfs_list = []
         for _ in range(replicates):
             sfs_list.append(copy.deepcopy(sfs_2d))
 
-        for site in range(filtered_encoded_alignment.shape[1]): # iterate over sites
-            site_data = list(filtered_encoded_alignment[:,site]) # get the data for that site
-
-            if (len(set(site_data)) == 2 and -1 not in site_data) or \
-                (len(set(site_data)) == 3 and -1 in site_data): # if it is > 1, keep going
-
-                for key, value in sfs_2d.items(): # iterate over population pairs
-
-                    # get the site data for those two populations
-                    site_data_pop1 = site_data[sampling_indices[key[0]][0]:
-                                               sampling_indices[key[0]][1]]
-                    site_data_pop2 = site_data[sampling_indices[key[1]][0]:
-                                               sampling_indices[key[1]][1]]
-
-
-                    # remove negative ones
-                    site_data_pop1 = [x for x in site_data_pop1 if not x == -1]
-                    site_data_pop2 = [x for x in site_data_pop2 if not x == -1]
-
-                    # sample random sites
-                    if len(site_data_pop1) > downsampling[key[0]]:
-                        site_data_pop1_sampled = [list(self.rng.choice(site_data_pop1, \
-                            downsampling[key[0]])) for m in range(replicates)]
-                    else:
-                        site_data_pop1_sampled = [site_data_pop1]*replicates
-
-                    if len(site_data_pop2) > downsampling[key[1]]:
-                        site_data_pop2_sampled = [list(self.rng.choice(site_data_pop2, \
-                            downsampling[key[1]])) for m in range(replicates)]
-                    else:
-                        site_data_pop2_sampled = [site_data_pop2]*replicates
-
-
-                    for k in range(replicates):
-
-                        all_site_data = site_data_pop1_sampled[k]+site_data_pop2_sampled[k]
-                        #print(all_site_data)
-
-                        # check that this site has two variants in these populations
-                        if len(set(all_site_data)) == 2:
-                            # get minor allele
-                            counter = Counter(all_site_data)
-                            min_count = min(counter.values())
-                            least_common_numbers = [num for num, cnt in counter.items() if cnt == min_count]
-                            minor_allele = self.rng.choice(least_common_numbers)
-                            #print(minor_allele)
-                            # find counts in each population
-                            pop1_count = Counter(site_data_pop1_sampled[k])[minor_allele]
-                            pop2_count = Counter(site_data_pop2_sampled[k])[minor_allele]
-                            #print(pop1_count, pop2_count)
-                            # add to the sfs
-                            sfs_list[k][key][pop1_count, pop2_count] += 1
-
+        for key, value in self._resample(encoded_alignment, downsampling, replicates,
+                                         msfs=False, pairs=list(sfs_2d))[1].items():
+            for k in range(replicates):
+                sfs_list[k][key] += value[k]
 
         return sfs_list
 
@@ -288,99 +247,321 @@ class DataProcessor:
             plt.savefig(outfile)
             plt.close()
 
-    def numpy_to_msfs(self, encoded_alignment, downsampling, replicates = 1, nbins=None):
+    def numpy_to_msfs(self, encoded_alignment, downsampling, replicates = 1, nbins=None,
+                      projection=False):
 
-        """Convert numpy array to multidimensional site frequency spectra"""
+        """Convert numpy array to multidimensional site frequency spectra. With
+        projection=True, return a single expected mSFS obtained by hypergeometric
+        projection of each site to the downsampling, instead of random subsampling
+        replicates."""
 
         # check that using even values
         key_even = all(value % 2 == 0 for value in downsampling.values())
         if not key_even:
             raise ValueError("Error in downampling, all keys must be even.")
 
-        all_sfs = []
+        layout = SFSLayout(OrderedDict({key: downsampling[key] for key in self.config["sampling dict"]}))
 
+        if projection:
+            spectra = self._project_msfs(*self._projection_pmfs(
+                encoded_alignment, downsampling))[None, :]
+        else:
+            spectra = self._resample(encoded_alignment, downsampling, replicates)[0]
 
-        # get indices for samples
-        current = 0
-        sampling_indices = {}
-        for key, value in self.config["sampling dict"].items():
-            sampling_indices[key] = [current, value + current]
-            current = current+value
-        reordered_downsampling = OrderedDict({key: downsampling[key] for key in self.config["sampling dict"]})
+        # convert SFS to binned
+        if not nbins is None:
+            spectra = layout.bin(spectra, nbins)
 
-        # remove columns that do not meet thresholds
-        sampled = 0
-        pop_failure_masks = []
-        for name, population in self.config["sampling dict"].items():
-            this_array = encoded_alignment[sampled:sampled+population,:]
-            mask = this_array==-1
-            count_minus_ones = np.sum(mask, axis=0)
-            failure_mask = count_minus_ones <= population - downsampling[name]
-            pop_failure_masks.append(failure_mask)
-            sampled += population
-        combined_mask = np.logical_and.reduce(pop_failure_masks)
-        filtered_encoded_alignment = encoded_alignment[:,combined_mask]
+        all_sfs = list(spectra)
 
-        for _ in range(replicates):
+        # calculate average number of sites used
+        average_sites = int(np.ceil(np.mean([np.sum(x) for x in all_sfs])))
+        print(f"We used an average of {average_sites} to construct the mSFS.")
 
-            # Generate all possible combinations of counts per population
-            combos = product(*(range(count + 1) for count in reordered_downsampling.values()))
-            rep_sfs_dict = OrderedDict({'_'.join(map(str, combo)): 0 for combo in combos})
-
-            for site in range(filtered_encoded_alignment.shape[1]): # iterate over sites
-                site_data = list(filtered_encoded_alignment[:,site]) # get the data for that site
-                if (len(set(site_data)) == 2 and -1 not in site_data) \
-                    or (len(set(site_data)) == 3 and -1 in site_data): # if it is > 1, keep going
-
-                    # get minor allele
-                    minor_allele = 1
-
-                    # find poulation counts
-                    counts_per_population = {}
-                    for population in self.config['sampling dict'].keys():
-
-                        site_data_pop = site_data[sampling_indices[population][0]:
-                                                sampling_indices[population][1]]
-
-                        if downsampling != self.config['sampling dict']:
-                            site_data_pop = [x for x in site_data_pop if not x == -1]
-                            site_data_pop = list(self.rng.choice(site_data_pop, \
-                                downsampling[population]))
-
-                        counts_per_population[population] = Counter(site_data_pop)[minor_allele]
-
-                    string_for_count = [x for x in list(counts_per_population.values())]
-                    if sum(string_for_count) != 0:
-                        string_for_count = [str(x) for x in string_for_count]
-                        combo_key = '_'.join(string_for_count)
-                        rep_sfs_dict[combo_key]+=1
-
-            # convert SFS to binned
-            if not nbins is None:
-                thresholds = []
-                for value in reordered_downsampling.values():
-                    thresholds.append([int(np.floor(value/nbins*(x+1))) for x in range(nbins)])
-                threshold_combos = list(product(*thresholds))
-                binned_rep_sfs_dict = OrderedDict({'_'.join(map(str, combo)): 0 for combo in threshold_combos})
-
-                for key, value in rep_sfs_dict.items():
-                    new_string = ''
-                    for count, entry in enumerate(key.split('_')):
-                        minthresh = min([x for x in thresholds[count] if int(entry) <= x])
-                        new_string+=str(minthresh)
-                        new_string+='_'
-                    new_string = new_string.strip('_')
-                    binned_rep_sfs_dict[new_string] += value
-                rep_sfs_dict = binned_rep_sfs_dict
-            
-            rep_sfs_dict = [value for value in rep_sfs_dict.values()]
-
-            all_sfs.append(np.array(rep_sfs_dict))
-
-            # calculate average number of sites used
+        return(all_sfs, average_sites)
 
+    def msfs_to_2d_sfs(self, all_sfs, downsampling):
+
+        """Derive the 2d SFS of every replicate from its (unbinned) mSFS, as returned by
+        numpy_to_msfs, by summing over the other populations. Each 2d SFS is polarized by
+        the minor allele of the pair; sites monomorphic within a pair are left out, and
+        sites with tied allele counts count half in each orientation. The 2d SFS thus
+        uses the same sites and subsamples as the mSFS."""
+
+        layout = SFSLayout(OrderedDict({key: downsampling[key] for key in self.config["sampling dict"]}))
+        joint_sfs = layout.pairwise(np.array(all_sfs))
+        return [{key: value[replicate] for key, value in joint_sfs.items()} \
+                for replicate in range(len(all_sfs))]
+
+    def numpy_to_sfs(self, encoded_alignment, downsampling, replicates = 1, projection=False,
+                     marginal=False):
+
+        """Convert numpy array to both the (unbinned) multidimensional and the 2d site
+        frequency spectra of each replicate, in a single pass over the sites. The sites are
+        filtered for the downsampling once, and the downsampled counts of a replicate are
+        shared by both spectra. With projection=True, return a single expected mSFS and 2d
+        SFS; with marginal=True, derive the 2d SFS from the mSFS (see msfs_to_2d_sfs).
+        encoded_alignment may also be the site counts returned by count_sites. Returns the
+        list of mSFS, the list of 2d SFS and the average number of sites used in the
+        mSFS."""
+
+        # check that using even values
+        key_even = all(value % 2 == 0 for value in downsampling.values())
+        if not key_even:
+            raise ValueError("Error in downampling, all keys must be even.")
+
+        sfs_2d = self._empty_2d_sfs(downsampling)
+        pairs = [] if marginal else list(sfs_2d)
+
+        if projection:
+            pmfs, weights = self._projection_pmfs(encoded_alignment, downsampling)
+            all_sfs = [self._project_msfs(pmfs, weights)]
+            sfs_list = [self._project_2d_sfs(pmfs, weights, pairs)]
+        else:
+            spectra, joint_sfs = self._resample(encoded_alignment, downsampling, replicates,
+                                                pairs=pairs)
+            all_sfs = list(spectra)
+            sfs_list = [{key: sfs_2d[key] + value[k] for key, value in joint_sfs.items()} \
+                        for k in range(replicates)]
+
+        if marginal:
+            sfs_list = self.msfs_to_2d_sfs(all_sfs, downsampling)
+
+        # calculate average number of sites used
         average_sites = int(np.ceil(np.mean([np.sum(x) for x in all_sfs])))
         print(f"We used an average of {average_sites} to construct the mSFS.")
 
-        return(all_sfs, average_sites)
-    
\ No newline at end of file
+        return(all_sfs, sfs_list, average_sites)
+
+    def numpy_to_sfs_grid(self, encoded_alignment, downsamplings, replicates = 1,
+                          projection=False, marginal=False):
+
+        """Run numpy_to_sfs for each of a list of downsampling dicts. The site counts are
+        computed once and shared, and the downsamplings are processed in parallel on
+        `cores` processes, each with its own random number generator seeded from that of
+        the processor. Returns the results of numpy_to_sfs, in the order of downsamplings."""
+
+        if not isinstance(encoded_alignment, tuple):
+            encoded_alignment = self.count_sites(encoded_alignment)
+        seeds = self.rng.integers(2**63, size=len(downsamplings))
+        options = dict(replicates=replicates, projection=projection, marginal=marginal)
+
+        # the workers only need the sampling dict, and are sent the counts once
+        processor = copy.copy(self)
+        processor.config = {"sampling dict": self.config["sampling dict"]}
+        if self.cores == 1 or len(downsamplings) == 1:
+            return [_downsampling_sfs(processor, encoded_alignment, downsampling, seed, options) \
+                    for downsampling, seed in zip(downsamplings, seeds)]
+        with ProcessPoolExecutor(max_workers=min(self.cores, len(downsamplings)),
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_grid_worker,
+                                 initargs=(processor, encoded_alignment)) as pool:
+            return list(pool.map(_grid_worker_sfs, downsamplings, seeds,
+                                 itertools.repeat(options)))
+
+    def _empty_2d_sfs(self, downsampling):
+
+        """Empty 2d SFS for every pair of populations, in the order of the sampling dict."""
+
+        populations = list(self.config["sampling dict"].keys())
+        sfs_2d = {}
+        for i, pop1 in enumerate(populations):
+            for j, pop2 in enumerate(populations):
+                if i < j:
+                    # create an empty 2D numpy array with the correct shape
+                    array_shape = (downsampling[pop1]+1, downsampling[pop2]+1)
+                    sfs_2d[(pop1, pop2)] = np.zeros(array_shape)
+        return sfs_2d
+
+    def _site_counts(self, block):
+
+        """Per-population numbers of non-missing haplotypes and of minor alleles (1) at each
+        site of a block, and a mask of the sites with exactly two alleles."""
+
+        biallelic = np.any(block == 0, axis=0) & np.any(block == 1, axis=0) & \
+            ~np.any(block > 1, axis=0)
+        present = []
+        minor = []
+        sampled = 0
+        for population in self.config['sampling dict'].values():
+            present.append(np.sum(block[sampled:sampled+population] != -1, axis=0))
+            minor.append(np.sum(block[sampled:sampled+population] == 1, axis=0))
+            sampled += population
+        return np.array(present), np.array(minor), biallelic
+
+    def _resample(self, encoded_alignment, downsampling, replicates, msfs=True, pairs=()):
+
+        """mSFS (flattened, last population varying fastest) and 2d SFS of each replicate,
+        in a single pass over the sites. The downsampled haplotypes of a population are
+        drawn with replacement from its non-missing haplotypes (when it has more than
+        needed), as binomial minor allele counts, once per site and replicate, and are
+        shared by the mSFS and by all pairs including that population. Returns the mSFS
+        (None unless msfs) and a dictionary of 2d SFS for the given pairs."""
+
+        populations = list(self.config["sampling dict"].keys())
+        layout = SFSLayout(OrderedDict((x, downsampling[x]) for x in populations))
+        sizes = np.array(list(layout.downsampling.values()))[:, None, None]
+        layouts = {key: SFSLayout(OrderedDict((x, downsampling[x]) for x in key))
+                   for key in pairs}
+        msfs_spectra = np.zeros((replicates, layout.size), dtype=np.int64) if msfs else None
+        spectra = {key: np.zeros((replicates, value.size), dtype=np.int64)
+                   for key, value in layouts.items()}
+
+        # bound the number of draws held at once
+        chunk = max(1, 2**22 // replicates)
+        for present, minor in self._iter_counts(encoded_alignment, downsampling):
+            for start in range(0, present.shape[1], chunk):
+                chunk_present = present[:, None, start:start+chunk]
+                chunk_minor = minor[:, None, start:start+chunk]
+                draw_shape = (len(sizes), replicates, chunk_present.shape[2])
+                counts = np.broadcast_to(chunk_minor, draw_shape)
+                if np.any(chunk_present > sizes):
+                    counts = np.where(chunk_present > sizes, self.rng.binomial(
+                        sizes, chunk_minor / chunk_present, size=draw_shape), counts)
+
+                # leave out sites without the minor allele in the downsampled data
+                if msfs:
+                    msfs_spectra += layout.histogram(counts, mask=counts.any(axis=0))
+
+                for (pop1, pop2), spectrum in spectra.items():
+                    size1 = downsampling[pop1]
+                    size2 = downsampling[pop2]
+                    count1 = counts[populations.index(pop1)]
+                    count2 = counts[populations.index(pop2)]
+
+                    # polarize by the minor allele of the pair, at random when tied
+                    total = count1 + count2
+                    flip = (2 * total > size1 + size2) | ((2 * total == size1 + size2) & \
+                        (self.rng.random(total.shape) < 0.5))
+                    count1 = np.where(flip, size1 - count1, count1)
+                    count2 = np.where(flip, size2 - count2, count2)
+
+                    # keep sites with both alleles in the pair
+                    spectrum += layouts[(pop1, pop2)].histogram(np.stack([count1, count2]),
+                        mask=(total > 0) & (total < size1 + size2))
+
+        return msfs_spectra, {key: value.reshape((replicates,) + layouts[key].shape)
+                              for key, value in spectra.items()}
+
+    def _projection_pmfs(self, encoded_alignment, downsampling):
+
+        """Hypergeometric probabilities of each minor allele count in the downsampled
+        populations, one row per distinct pattern of biallelic site, and the number of
+        sites with that pattern."""
+
+        npops = len(self.config['sampling dict'])
+        patterns = []
+        counts = []
+        for present, minor in self._iter_counts(encoded_alignment, downsampling):
+            block_patterns, block_counts = np.unique(
+                np.vstack([present, minor]).T, axis=0, return_counts=True)
+            patterns.append(block_patterns)
+            counts.append(block_counts)
+        patterns = np.concatenate(patterns) if patterns else np.empty((0, 2*npops), dtype=int)
+        patterns, inverse = np.unique(patterns, axis=0, return_inverse=True)
+        weights = np.bincount(inverse.ravel(), weights=np.concatenate(counts) if counts else None,
+                              minlength=len(patterns))
+
+        pmfs = []
+        for index, name in enumerate(self.config['sampling dict']):
+            pmfs.append(hypergeometric_pmf(patterns[:, index], patterns[:, npops+index],
+                                           downsampling[name]))
+        return pmfs, weights
+
+    def _project_msfs(self, pmfs, weights):
+
+        """Expected mSFS (flattened, last population varying fastest), excluding sites
+        without the minor allele in the downsampled data."""
+
+        expected = expected_spectrum(pmfs, weights)
+        expected[0] = 0
+        return expected
+
+    def _project_2d_sfs(self, pmfs, weights, sfs_2d):
+
+        """Expected 2d SFS for every pair of populations, polarized by the minor allele
+        of the pair (split evenly between both orientations when allele counts are tied)."""
+
+        populations = list(self.config["sampling dict"].keys())
+
+        expected_sfs = {}
+        for (pop1, pop2) in sfs_2d:
+            expected = (weights[:, None] * pmfs[populations.index(pop1)]).T @ \
+                pmfs[populations.index(pop2)]
+            expected_sfs[(pop1, pop2)] = fold_pair(expected)
+        return expected_sfs
+
+
+def expand_downsampling(downsampling):
+
+    """List of downsampling dicts given either a dict, a list of dicts, or a grid: a dict
+    whose values may be lists of sizes, expanded to every combination of the sizes."""
+
+    if isinstance(downsampling, dict):
+        values = [value if isinstance(value, (list, tuple)) else [value] \
+                  for value in downsampling.values()]
+        return [dict(zip(downsampling, sizes)) for sizes in itertools.product(*values)]
+    return [dict(item) for item in downsampling]
+
+_grid_worker = None
+
+def _init_grid_worker(processor, counts):
+    global _grid_worker
+    _grid_worker = (processor, counts)
+
+def _grid_worker_sfs(downsampling, seed, options):
+    return _downsampling_sfs(*_grid_worker, downsampling, seed, options)
+
+def _downsampling_sfs(processor, counts, downsampling, seed, options):
+
+    """numpy_to_sfs of the counts for one downsampling, with a generator seeded by seed."""
+
+    processor = copy.copy(processor)
+    processor.rng = np.random.default_rng(seed)
+    return processor.numpy_to_sfs(counts, downsampling, **options)
+
+class _ColumnWriter:
+
+    """Stream blocks of columns of a (rows, sites) int8 matrix to disk, so that the matrix
+    never has to fit in memory. Given a path, the columns are written to a Fortran-ordered
+    .npy file there; otherwise to an anonymous temporary file, which is removed once the
+    returned matrix is no longer used. Either way the matrix is returned memory-mapped."""
+
+    def __init__(self, nrows, path=None):
+        self.nrows = nrows
+        self.path = path
+        self.ncols = 0
+        if path is None:
+            self.raw = tempfile.TemporaryFile()
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.raw_path = f"{path}.{os.getpid()}.raw"
+            self.raw = open(self.raw_path, 'wb')
+
+    def append(self, block):
+        self.raw.write(np.asarray(block, dtype=np.int8).tobytes(order='F'))
+        self.ncols += block.shape[1]
+
+    def finish(self):
+        if self.path is None:
+            self.raw.flush()
+            if self.ncols == 0:
+                self.raw.close()
+                return np.empty((self.nrows, 0), dtype=np.int8)
+            # the mapping keeps the data after the file is closed
+            matrix = np.memmap(self.raw, dtype=np.int8, mode='r', shape=(self.nrows, self.ncols),
+                               order='F')
+            self.raw.close()
+            return matrix
+
+        # write the header, copy the columns after it and move the file into place
+        self.raw.close()
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as f, open(self.raw_path, 'rb') as raw:
+            np.lib.format.write_array_header_1_0(f, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(np.int8)),
+                'fortran_order': True, 'shape': (self.nrows, self.ncols)})
+            shutil.copyfileobj(raw, f)
+        os.remove(self.raw_path)
+        os.replace(temporary_path, self.path)
+        return np.load(self.path, mmap_mode='r')
@@ -0,0 +1,340 @@
+"""This module contains the layout of multidimensional site frequency spectra shared by simulated and empirical data."""
+import os
+from collections import OrderedDict
+from itertools import combinations
+import numpy as np
+from scipy import sparse
+from popai.utils import hypergeometric_pmf
+
+def stack(spectra):
+
+    """Stack flat spectra into one row per spectrum, keeping sparse spectra sparse."""
+
+    if not len(spectra):
+        return np.empty((0, 0))
+    if sparse.issparse(spectra[0]):
+        return sparse.vstack(spectra, format="csr")
+    return np.array(spectra).reshape(len(spectra), -1)
+
+def fold_pair(joint):
+
+    """Polarize joint spectra of two populations (last two axes, indexed by the counts of
+    an allele) by the minor allele within the pair. Cells where the allele is absent from,
+    or fixed in, both populations are dropped; cells where both alleles are equally common
+    are split evenly between both orientations."""
+
+    total = np.add.outer(np.arange(joint.shape[-2]), np.arange(joint.shape[-1]))
+    size = joint.shape[-2] + joint.shape[-1] - 2
+    minor = (total > 0) & (2 * total < size)
+    major = (2 * total > size) & (total < size)
+    tied = 2 * total == size
+    return np.where(minor, joint, 0) + np.flip(np.where(major, joint, 0), axis=(-2, -1)) + \
+        0.5 * (np.where(tied, joint, 0) + np.flip(np.where(tied, joint, 0), axis=(-2, -1)))
+
+def expected_spectrum(pmfs, weights):
+
+    """Flat expected spectrum (last population varying fastest) of groups of sites, given
+    for each population the probabilities of every count (one row per group) and the
+    number of sites in each group."""
+
+    # sum over groups of the weighted outer product of the per-population probabilities,
+    # in chunks of groups to bound memory
+    leading_size = int(np.prod([x.shape[1] for x in pmfs[:-1]]))
+    chunk = max(1, 2**22 // leading_size)
+    expected = np.zeros((leading_size, pmfs[-1].shape[1]))
+    for start in range(0, len(weights), chunk):
+        joint = np.asarray(weights[start:start+chunk], dtype=float)[:, None]
+        for pmf in pmfs[:-1]:
+            joint = (joint[:, :, None] * pmf[start:start+chunk, None, :]).reshape(
+                joint.shape[0], -1)
+        expected += joint.T @ pmfs[-1][start:start+chunk]
+    return expected.ravel()
+
+def limit_sites(spectra, max_sites):
+
+    """Scale down dense spectra (one per row) with more than max_sites sites to max_sites
+    sites, the expected spectra of max_sites of their sites."""
+
+    totals = spectra.sum(axis=1, keepdims=True)
+    return spectra * np.minimum(1, max_sites / np.maximum(totals, 1e-300))
+
+class SFSLayout:
+
+    """Layout of a multidimensional SFS, with one axis per population of length the
+    (downsampled) number of haplotypes plus one. Spectra are stored as flat arrays in
+    mixed-radix order, the last population varying fastest, and can be reshaped to
+    `shape` to be used as tensors. With many populations most cells are empty, and
+    spectra can instead be kept as sparse (CSR) matrices with one row per spectrum, whose
+    size depends on the number of occupied cells only."""
+
+    def __init__(self, downsampling):
+        self.downsampling = OrderedDict(downsampling)
+        self.populations = list(self.downsampling.keys())
+        self.shape = tuple(count + 1 for count in self.downsampling.values())
+        self.size = int(np.prod(self.shape))
+        self._bin_index = {}
+
+    def index(self, counts):
+
+        """Flat index of the cells given the per-population counts along the first axis."""
+
+        return np.ravel_multi_index(tuple(counts), self.shape)
+
+    def histogram(self, counts, mask=None, sparse_output=False):
+
+        """Count sites in each cell. The per-population counts are along the first axis of
+        counts and sites along the last one. Any axes in between (e.g. replicates) give
+        separate spectra. Sites where mask is False are left out. With sparse_output,
+        return a CSR matrix with one row per spectrum."""
+
+        index = self.index(counts)
+        batch = index.shape[:-1]
+        nspectra = int(np.prod(batch))
+        if sparse_output:
+            rows = np.broadcast_to(np.arange(nspectra).reshape(batch + (1,)), index.shape)
+            if mask is not None:
+                mask = np.broadcast_to(mask, index.shape)
+                rows, index = rows[mask], index[mask]
+            return sparse.csr_matrix((np.ones(index.size, dtype=np.int64),
+                (rows.ravel(), index.ravel())), shape=(nspectra, self.size))
+        index = index + self.size * np.arange(nspectra).reshape(batch + (1,))
+        if mask is not None:
+            index = index[np.broadcast_to(mask, index.shape)]
+        return np.bincount(index.ravel(), minlength=nspectra * self.size).reshape(
+            batch + (self.size,))
+
+    def pairwise(self, sfs):
+
+        """Joint SFS of every pair of populations, obtained by summing flat spectra (last
+        axis) over the other populations and folding with fold_pair. Sites monomorphic
+        within a pair are left out of that pair's spectrum, and sites with tied allele
+        counts within a pair count half in each orientation."""
+
+        joint_sfs = OrderedDict()
+        if sparse.issparse(sfs):
+            sfs = sfs.tocoo()
+            cells = np.unravel_index(sfs.col, self.shape)
+            for i, j in combinations(range(len(self.shape)), 2):
+                joint = np.zeros((sfs.shape[0], self.shape[i], self.shape[j]))
+                np.add.at(joint, (sfs.row, cells[i], cells[j]), sfs.data)
+                joint_sfs[(self.populations[i], self.populations[j])] = fold_pair(joint)
+            return joint_sfs
+
+        batch = sfs.shape[:-1]
+        tensor = sfs.reshape(batch + self.shape)
+        for i, j in combinations(range(len(self.shape)), 2):
+            others = tuple(len(batch) + k for k in range(len(self.shape)) if k not in (i, j))
+            joint_sfs[(self.populations[i], self.populations[j])] = fold_pair(
+                tensor.sum(axis=others).astype(float))
+        return joint_sfs
+
+    def fold(self, sfs):
+
+        """Polarize flat spectra (last axis), indexed by the counts of an allele, by the
+        minor allele over all populations. Cells where the allele is absent or fixed are
+        dropped, and cells where both alleles are equally common are split evenly between
+        both orientations."""
+
+        counts = np.indices(self.shape).reshape(len(self.shape), -1)
+        total = counts.sum(axis=0)
+        size = sum(self.downsampling.values())
+        flipped = self.index(np.array(list(self.downsampling.values()))[:, None] - counts)
+        minor = (total > 0) & (2 * total < size)
+        major = (2 * total > size) & (total < size)
+        tied = 2 * total == size
+
+        folded = np.where(minor, sfs, 0)
+        folded[..., flipped[major]] += sfs[..., major]
+        folded[..., tied] += 0.5 * sfs[..., tied]
+        folded[..., flipped[tied]] += 0.5 * sfs[..., tied]
+        return folded
+
+    def project(self, sfs, downsampling):
+
+        """Project spectra (one per row, dense or sparse) to smaller samples, drawn without
+        replacement within each population, and return the expected spectra with their
+        layout. The projected spectra are polarized by the minor allele of the smaller
+        samples (see fold), as spectra built directly from those samples would be. Sites
+        that are monomorphic in the smaller samples are dropped, so projected spectra have
+        fewer sites (see limit_sites)."""
+
+        target = SFSLayout(OrderedDict((key, downsampling[key]) for key in self.populations))
+        if any(target.shape[i] > self.shape[i] for i in range(len(self.shape))):
+            raise ValueError("Error in downsampling, can not project to more haplotypes than were sampled.")
+        tables = [hypergeometric_pmf(size, np.arange(size + 1), downsampling[key]) \
+                  for key, size in self.downsampling.items()]
+
+        sfs = sparse.csr_matrix(sfs.reshape(-1, self.size) if not sparse.issparse(sfs) else sfs)
+        projected = np.zeros((sfs.shape[0], target.size))
+        for row in range(sfs.shape[0]):
+            cells = sfs.indices[sfs.indptr[row]:sfs.indptr[row+1]]
+            weights = sfs.data[sfs.indptr[row]:sfs.indptr[row+1]]
+            counts = np.unravel_index(cells, self.shape)
+            projected[row] = expected_spectrum(
+                [table[count] for table, count in zip(tables, counts)], weights)
+        return target.fold(projected), target
+
+    def thresholds(self, nbins):
+
+        """Upper count of each of the nbins bins of every population (repeated bounds,
+        which occur when a population has fewer haplotypes than bins, are merged)."""
+
+        thresholds = []
+        for value in self.downsampling.values():
+            thresholds.append(list(OrderedDict.fromkeys(
+                int(np.floor(value/nbins*(x+1))) for x in range(nbins))))
+        return thresholds
+
+    def bin_index(self, nbins):
+
+        """Bin of every count of each population, as one lookup array per population. The
+        arrays are computed once per number of bins."""
+
+        if nbins not in self._bin_index:
+            self._bin_index[nbins] = [np.searchsorted(thresholds, np.arange(size)) \
+                for thresholds, size in zip(self.thresholds(nbins), self.shape)]
+        return self._bin_index[nbins]
+
+    def bin(self, sfs, nbins):
+
+        """Sum the cells of flat spectra (last axis) into nbins bins per population, a
+        count being assigned to the lowest bin whose upper count is not below it."""
+
+        if sparse.issparse(sfs):
+            sfs = sfs.tocoo()
+            bin_index = self.bin_index(nbins)
+            binned_shape = tuple(index[-1] + 1 for index in bin_index)
+            cells = np.unravel_index(sfs.col, self.shape)
+            binned = np.ravel_multi_index(tuple(index[cell] for index, cell in \
+                zip(bin_index, cells)), binned_shape)
+            return sparse.csr_matrix((sfs.data, (sfs.row, binned)),
+                                     shape=(sfs.shape[0], int(np.prod(binned_shape))))
+
+        batch = sfs.shape[:-1]
+        binned = sfs.reshape(batch + self.shape)
+        for axis, index in enumerate(self.bin_index(nbins)):
+            # bins are contiguous runs of counts, so each is a sum over a slice
+            starts = np.flatnonzero(np.diff(index, prepend=-1))
+            binned = np.add.reduceat(binned, starts, axis=len(batch) + axis)
+        return binned.reshape(batch + (-1,))
+
+class SFSPyramid:
+
+    """Full-resolution multidimensional SFS of a set of datasets (one per row), from which
+    binned spectra of any resolution are derived on demand. Derived levels are cached,
+    and saved along with the full-resolution spectra (unless these are stored elsewhere).
+    The joint SFS of every pair of populations (one array per pair, with one row per
+    dataset) and the number of bins the spectra are used with by default can be saved in
+    the same file."""
+
+    def __init__(self, layout, spectra, keys=None, levels=None, joint=None, nbins=None):
+        self.layout = layout
+        self.spectra = spectra if sparse.issparse(spectra) else np.asarray(spectra)
+        self.keys = keys
+        self.levels = dict(levels) if levels else {}
+        self.joint = OrderedDict(joint) if joint else OrderedDict()
+        self.nbins = nbins
+        self._external = False
+
+    @classmethod
+    def from_dict(cls, layout, sfs_dict):
+
+        """Build a pyramid from a dictionary of lists of spectra (e.g. one list per model)."""
+
+        keys = [key for key, values in sfs_dict.items() for _ in values]
+        spectra = [sfs for values in sfs_dict.values() for sfs in values]
+        return cls(layout, stack(spectra), keys=keys)
+
+    def level(self, nbins=None):
+
+        """Spectra binned into nbins bins per population (full resolution if None)."""
+
+        if nbins is None:
+            return self.spectra
+        if nbins not in self.levels:
+            self.levels[nbins] = self.layout.bin(self.spectra, nbins)
+        return self.levels[nbins]
+
+    def to_dict(self, nbins=None):
+
+        """Spectra at a given resolution as a dictionary of lists, keyed as in from_dict."""
+
+        sfs_dict = OrderedDict()
+        for key, sfs in zip(self.keys, self.level(nbins)):
+            sfs_dict.setdefault(key, []).append(sfs)
+        return sfs_dict
+
+    def joint_dicts(self):
+
+        """Joint SFS as a list with, for each dataset, a dictionary keyed by pair."""
+
+        return [{pair: value[row] for pair, value in self.joint.items()} \
+                for row in range(self.spectra.shape[0])]
+
+    def save(self, path, spectra=None):
+
+        """Write the full-resolution spectra, the derived levels and the joint SFS to an
+        .npz file, through a temporary file so that an interrupted write leaves any
+        existing file intact. With spectra=False the full-resolution spectra are left out
+        (e.g. when they are already stored with the training data), and have to be given
+        to load; by default they are left out only if they were given to load."""
+
+        if spectra is None:
+            spectra = not self._external
+        arrays = {}
+        if spectra:
+            _pack(arrays, "spectra", self.spectra)
+        for nbins, value in self.levels.items():
+            _pack(arrays, f"nbins_{nbins}", value)
+        if self.keys is not None:
+            arrays["keys"] = np.array(self.keys)
+        if self.joint:
+            arrays["pairs"] = np.array(list(self.joint))
+            for index, value in enumerate(self.joint.values()):
+                arrays[f"jsfs_{index}"] = np.asarray(value)
+        if self.nbins is not None:
+            arrays["nbins"] = np.array(self.nbins)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as f:
+            np.savez(f, populations=np.array(self.layout.populations),
+                     sizes=np.array(list(self.layout.downsampling.values())), **arrays)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path, spectra=None):
+
+        """Read a pyramid written by save. spectra are the full-resolution spectra, used
+        if the file was written without them."""
+
+        with np.load(path) as data:
+            layout = SFSLayout(OrderedDict(zip(data["populations"].tolist(),
+                                               data["sizes"].tolist())))
+            keys = data["keys"].tolist() if "keys" in data else None
+            levels = {int(name.split('_')[1]): _unpack(data, name) for name in \
+                      {x.split('.')[0] for x in data.files if x.startswith("nbins_")}}
+            pairs = data["pairs"].tolist() if "pairs" in data else []
+            joint = [(tuple(pair), data[f"jsfs_{index}"]) for index, pair in enumerate(pairs)]
+            nbins = int(data["nbins"]) if "nbins" in data else None
+            external = "spectra" not in data and "spectra.indptr" not in data
+            if external and spectra is None:
+                raise ValueError(f"Error: {path} does not hold the full-resolution spectra, which have to be given.")
+            pyramid = cls(layout, spectra if external else _unpack(data, "spectra"), keys=keys,
+                          levels=levels, joint=joint, nbins=nbins)
+        pyramid._external = external
+        return pyramid
+
+def _pack(arrays, name, value):
+    if sparse.issparse(value):
+        value = value.tocsr()
+        arrays[f"{name}.data"] = value.data
+        arrays[f"{name}.indices"] = value.indices
+        arrays[f"{name}.indptr"] = value.indptr
+        arrays[f"{name}.shape"] = np.array(value.shape)
+    else:
+        arrays[name] = value
+
+def _unpack(data, name):
+    if f"{name}.indptr" in data:
+        return sparse.csr_matrix((data[f"{name}.data"], data[f"{name}.indices"],
+                                  data[f"{name}.indptr"]), shape=tuple(data[f"{name}.shape"]))
+    return data[name]
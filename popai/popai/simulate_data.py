@@ -2,7 +2,6 @@
 import logging
 import time # for testing only
 from collections import Counter, OrderedDict
-from itertools import product
 import os
 import msprime
 import numpy as np
@@ -11,6 +10,7 @@ logging.getLogger('msprime').setLevel("WARNING")
 import sys
 import pyslim
 import dendropy
+from popai.sfs import SFSLayout, stack
 from popai.utils import minor_encoding
 
 class DataSimulator:
@@ -37,6 +37,10 @@ class DataSimulator:
 
         self.rng = np.random.default_rng(self.config['seed'])
 
+        # layout of the mSFS, populations ordered as in the sampling dict
+        self.layout = SFSLayout(OrderedDict({key: self.downsampling[key] for \
+                                             key in self.config["sampling dict"]}))
+
         # Configure logging
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger(__name__)
@@ -96,72 +100,50 @@ class DataSimulator:
 
         return all_arrays
 
-    def mutations_to_sfs(self, numpy_array_dict, nbins=None):
+    def mutations_to_sfs(self, numpy_array_dict, nbins=None, sparse=False):
 
-        """Convert numpy arrays to multidimensional site frequency spectra"""
+        """Convert numpy arrays to multidimensional site frequency spectra. With sparse,
+        each spectrum is a sparse (CSR) matrix with a single row, so that memory depends
+        on the number of occupied cells rather than on the number of populations."""
 
         all_sfs = {}
 
         # get indices for samples
-        reordered_downsampling = OrderedDict({key: self.downsampling[key] for \
-                                  key in self.config["sampling dict"]})
+        layout = self.layout
 
         current = 0
         sampling_indices = {}
-        for key, value in reordered_downsampling.items():
+        for key, value in layout.downsampling.items():
             sampling_indices[key] = [current, value + current]
             current = current+value
 
         for modelkey, values in numpy_array_dict.items():
 
-            model_replicates = []
             all_sfs[modelkey] = []
 
             for replicate in values:
 
-                # Generate all possible combinations of counts per population
-                combos = product(*(range(count + 1) for count in reordered_downsampling.values()))
-                rep_sfs_dict = OrderedDict({'_'.join(map(str, combo)): 0 for combo in combos})
-
-                for site in range(replicate.shape[1]):
-
-                    site_data = list(replicate[:,site])
-
-                    if len(set(site_data)) == 2:
-
-                        # get minor allele
-                        minor_allele = min(set(site_data), key=site_data.count)
-                        # find poulation counts
-                        counts_per_population = {}
-                        for population in self.config['sampling dict'].keys():
-                            site_data_pop = site_data[sampling_indices[population][0]:
-                                                      sampling_indices[population][1]]
-                            counts_per_population[population] = Counter(site_data_pop)[minor_allele]
-                        string_for_count = [str(x) for x in list(counts_per_population.values())]
-                        combo_key = '_'.join(string_for_count)
-                        rep_sfs_dict[combo_key]+=1
+                # sites with exactly two states; the minor allele is the less common one,
+                # the lower allele when tied (missing data, -1, ranks last)
+                states = np.array([0, 1, 2, 3, -1])
+                frequencies = np.stack([np.count_nonzero(replicate == state, axis=0) \
+                                        for state in states])
+                biallelic = np.count_nonzero(frequencies, axis=0) == 2
+                minor_allele = states[np.argmin(np.where(frequencies > 0, frequencies,
+                                                         replicate.shape[0] + 1), axis=0)]
+
+                # find poulation counts
+                counts_per_population = np.stack([np.count_nonzero(
+                    replicate[start:end] == minor_allele, axis=0) \
+                    for start, end in sampling_indices.values()])
+                rep_sfs = layout.histogram(counts_per_population, mask=biallelic,
+                                           sparse_output=sparse)
 
                 # convert SFS to binned
                 if not nbins is None:
-                    thresholds = []
-                    for value in reordered_downsampling.values():
-                        thresholds.append([int(np.floor(value/nbins*(x+1))) for x in range(nbins)])
-                    threshold_combos = list(product(*thresholds))
-                    binned_rep_sfs_dict = OrderedDict({'_'.join(map(str, combo)): \
-                                           0 for combo in threshold_combos})
-
-                    for key, value in rep_sfs_dict.items():
-                        new_string = ''
-                        for count, entry in enumerate(key.split('_')):
-                            minthresh = min([x for x in thresholds[count] if int(entry) <= x])
-                            new_string+=str(minthresh)
-                            new_string+='_'
-                        new_string = new_string.strip('_')
-                        binned_rep_sfs_dict[new_string] += value
-                    rep_sfs_dict = binned_rep_sfs_dict
-
-                rep_sfs_dict = [value for value in rep_sfs_dict.values()]
-                all_sfs[modelkey].append(np.array(rep_sfs_dict))
+                    rep_sfs = layout.bin(rep_sfs, nbins)
+
+                all_sfs[modelkey].append(rep_sfs)
 
 
         return all_sfs
@@ -228,6 +210,22 @@ class DataSimulator:
 
         return all_sfs
 
+    def msfs_to_2d_sfs(self, msfs):
+
+        """Derive the 2d SFS of every replicate from its (unbinned) mSFS, as returned by
+        mutations_to_sfs, by summing over the other populations, instead of going back to
+        the simulated genotypes. Sites monomorphic within a pair are left out, and sites
+        with tied allele counts within a pair count half in each orientation, rather than
+        being oriented at random. Unlike mutations_to_2d_sfs, sites with more than two
+        alleles overall are not used."""
+
+        all_sfs = {}
+        for modelkey, values in msfs.items():
+            joint_sfs = self.layout.pairwise(stack(values))
+            all_sfs[modelkey] = [{key: value[replicate] for key, value in joint_sfs.items()} \
+                                 for replicate in range(len(values))]
+        return all_sfs
+
     def plot_2dsfs(self, sfs_list, output_directory=None):
         """Plot average 2 dimensional Site frequency spectra."""
 
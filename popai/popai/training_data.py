@@ -0,0 +1,107 @@
+"""This module contains the store of simulated training data read by the predictors."""
+import os
+import numpy as np
+from scipy import sparse
+
+class TrainingData:
+
+    """Simulated datasets stored in a directory, with one .npy file per feature type (the
+    features of all datasets stacked along the first axis) and one with the label of each
+    dataset. Each file can be memory-mapped on its own, so that only the features used
+    are read. The joint SFS of all pairs are stored side by side in one array, and the
+    mSFS as the arrays of a CSR matrix when sparse."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @classmethod
+    def write(cls, directory, keys, msfs=None, jsfs=None, arrays=None):
+
+        """Write the features of each dataset: msfs, an array or sparse matrix with one row
+        per dataset; jsfs, a dictionary of arrays keyed by pair, with one row per dataset;
+        and arrays, the simulated alignments. keys are the labels of the datasets."""
+
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'labels.npy'), np.array(keys))
+        if msfs is not None:
+            if sparse.issparse(msfs):
+                msfs = msfs.tocsr()
+                for name in ('data', 'indices', 'indptr'):
+                    np.save(os.path.join(directory, f'msfs.{name}.npy'), getattr(msfs, name))
+                np.save(os.path.join(directory, 'msfs.shape.npy'), np.array(msfs.shape))
+            else:
+                np.save(os.path.join(directory, 'msfs.npy'), np.asarray(msfs))
+        if jsfs is not None:
+            np.save(os.path.join(directory, 'jsfs.pairs.npy'), np.array(list(jsfs)))
+            np.save(os.path.join(directory, 'jsfs.shapes.npy'),
+                    np.array([value.shape[1:] for value in jsfs.values()]))
+            np.save(os.path.join(directory, 'jsfs.npy'), np.concatenate(
+                [value.reshape(len(keys), -1) for value in jsfs.values()], axis=1))
+        if arrays is not None:
+            np.save(os.path.join(directory, 'arrays.npy'), np.asarray(arrays))
+        return cls(directory)
+
+    @classmethod
+    def from_dicts(cls, directory, msfs=None, jsfs=None, arrays=None):
+
+        """Write features given as dictionaries of lists (one list of datasets per model),
+        as returned by the simulator; the datasets of the dictionaries must be in the
+        same order."""
+
+        source = next(x for x in (msfs, jsfs, arrays) if x is not None)
+        keys = [key for key, values in source.items() for _ in values]
+        if msfs is not None:
+            values = [x for values in msfs.values() for x in values]
+            msfs = sparse.vstack(values, format='csr') if values and sparse.issparse(values[0]) \
+                else np.array(values).reshape(len(values), -1)
+        if jsfs is not None:
+            values = [x for values in jsfs.values() for x in values]
+            jsfs = {pair: np.stack([x[pair] for x in values]) for pair in values[0]}
+        if arrays is not None:
+            arrays = np.array([x for values in arrays.values() for x in values])
+        return cls.write(directory, keys, msfs=msfs, jsfs=jsfs, arrays=arrays)
+
+    def labels(self):
+
+        """Label of each dataset."""
+
+        return np.load(os.path.join(self.directory, 'labels.npy'))
+
+    def msfs(self):
+
+        """mSFS of all datasets, one per row, memory-mapped (or a CSR matrix over
+        memory-mapped arrays)."""
+
+        path = os.path.join(self.directory, 'msfs.npy')
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+        data, indices, indptr = (np.load(os.path.join(self.directory, f'msfs.{name}.npy'),
+                                         mmap_mode='r') for name in ('data', 'indices', 'indptr'))
+        shape = tuple(np.load(os.path.join(self.directory, 'msfs.shape.npy')))
+        return sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+    def jsfs(self):
+
+        """Joint SFS of all datasets as a dictionary keyed by pair, each a memory-mapped
+        view with one SFS per dataset along the first axis."""
+
+        pairs = [tuple(x) for x in np.load(os.path.join(self.directory, 'jsfs.pairs.npy')).tolist()]
+        shapes = np.load(os.path.join(self.directory, 'jsfs.shapes.npy'))
+        features = np.load(os.path.join(self.directory, 'jsfs.npy'), mmap_mode='r')
+        jsfs = {}
+        start = 0
+        for pair, shape in zip(pairs, shapes):
+            size = int(np.prod(shape))
+            jsfs[pair] = features[:, start:start+size].reshape((-1,) + tuple(shape))
+            start += size
+        return jsfs
+
+    def arrays(self):
+
+        """Simulated alignments of all datasets, memory-mapped."""
+
+        return np.load(os.path.join(self.directory, 'arrays.npy'), mmap_mode='r')
+
+    def __contains__(self, name):
+        return os.path.exists(os.path.join(self.directory, f'{name}.npy')) or \
+            os.path.exists(os.path.join(self.directory, f'{name}.shape.npy'))
@@ -1,13 +1,63 @@
-from collections import Counter
+import numpy as np
+from scipy.special import gammaln
 
 def minor_encoding(arr):
+    """Recode the alleles of every column by decreasing frequency (most common allele 0),
+    ties broken by first occurrence. Missing data (-1) is left as is."""
     result = arr.copy()
-    for col in range(arr.shape[1]):
-        column = arr[:, col]
-        column = column[column != -1]
-        freq = Counter(column)
-        sorted_values = [item[0] for item in freq.most_common()]
-        value_to_rank = {value: rank for rank, value in enumerate(sorted_values)}
-        for original_value, new_value in value_to_rank.items():
-            result[arr[:, col] == original_value, col] = new_value
+    if arr.size == 0:
+        return result
+    nalleles = int(arr.max()) + 1
+    if nalleles <= 0:
+        return result
+    counts = allele_counts(arr, nalleles)
+    first = np.full((arr.shape[1], nalleles), arr.shape[0], dtype=np.int64)
+    for allele in range(nalleles):
+        present = arr == allele
+        first[:, allele] = np.where(present.any(axis=0), present.argmax(axis=0), arr.shape[0])
+    order = np.lexsort((first, -counts), axis=1)
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(nalleles)[None, :], axis=1)
+    observed = arr != -1
+    columns = np.broadcast_to(np.arange(arr.shape[1]), arr.shape)
+    result[observed] = ranks[columns[observed], arr[observed]]
+    return result
+
+def allele_counts(arr, nalleles=4):
+    """Count alleles 0..nalleles-1 in every column of arr, returning a (columns, nalleles) array."""
+    counts = np.zeros((arr.shape[1], nalleles), dtype=np.int64)
+    for allele in range(nalleles):
+        counts[:, allele] = np.count_nonzero(arr == allele, axis=0)
+    return counts
+
+def remove_invariant_sites(arr):
+    """Drop columns in which at most one of the four alleles occurs."""
+    frequencies = allele_counts(arr)
+    return arr[:, np.sum(frequencies == 0, axis=1) < 3]
+
+def hypergeometric_pmf(present, minor, sample):
+    """Probability of drawing k copies of an allele present `minor` times among `present`
+    haplotypes when sampling `sample` of them without replacement, for k <= sample. present
+    and minor are broadcast together, and the result has one more axis, indexed by k. Entries
+    with present < sample are zero."""
+    present = np.asarray(present, dtype=np.int64)[..., None]
+    minor = np.asarray(minor, dtype=np.int64)[..., None]
+    k = np.arange(sample + 1)
+
+    def log_choose(a, b):
+        valid = (b >= 0) & (b <= a)
+        a, b = np.where(valid, a, 0), np.where(valid, b, 0)
+        return np.where(valid, gammaln(a + 1) - gammaln(b + 1) - gammaln(a - b + 1), -np.inf)
+
+    valid = (present >= sample) & (minor <= present)
+    log_pmf = log_choose(minor, k) + log_choose(present - minor, sample - k) \
+        - np.where(valid, log_choose(present, np.full_like(present, sample)), 0.0)
+    return np.where(valid, np.exp(log_pmf), 0.0)
+
+def limit_alignment_sites(arr, max_sites):
+    """Keep the first max_sites sites of an encoded alignment, padding it with missing data
+    (-1) to that width."""
+    result = np.full((arr.shape[0], max_sites), -1, dtype=arr.dtype)
+    sites = min(arr.shape[1], max_sites)
+    result[:, :sites] = arr[:, :sites]
     return result
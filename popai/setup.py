@@ -14,6 +14,7 @@ setup(
         'matplotlib',
         'argparse',
         'scikit-learn',
+        'scipy',
         'keras',
         'seaborn',
         'tabulate',
@@ -25,6 +26,7 @@ setup(
         'console_scripts': [
             'process_empirical_data=popai.cli_process_empirical_data:main',
             'simulate_data=popai.cli_simulate_data:main',
+            'project_simulations=popai.cli_project_simulations:main',
             'train_models=popai.cli_train_models:main',
             'apply_models=popai.cli_apply_models:main'
         ],
@@ -0,0 +1,85 @@
+import unittest
+import tempfile
+import os
+import sys
+import pickle
+from unittest import mock
+import numpy as np
+import numpy.testing as npt
+from sklearn.ensemble import RandomForestClassifier
+from popai import cli_apply_models, cli_process_empirical_data
+
+class TestApplyModels(unittest.TestCase):
+
+    """Test applying trained models to processed empirical data."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.temp_config_file = os.path.join(self.temp_dir.name, 'test_config.ini')
+
+        # Create a sample config file for testing
+        with open(self.temp_config_file, 'w', encoding='utf-8') as f:
+            f.write("""
+[Model]
+species tree file = ./tests/species_tree_mini.nex
+migration matrix = ./tests/migration_mini.txt
+symmetric = True
+secondary contact = True
+divergence with gene flow = False
+max migration events = 1
+migration rate = U(1e-5, 1e-4)
+constant Ne = True # population sizes equal across all populations
+
+[Other]
+output directory = ./examples/test_mini
+seed = 1234
+replicates = 10
+
+[Simulations]
+mutation rate = U(1e-8, 1e-7)
+substitution model = JC69
+
+[Data]
+alignments = ./tests/mini_dataset/
+popfile = ./tests/populations_mini.txt
+
+            """)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_main(self, module, *args):
+        with mock.patch.object(sys, 'argv', [module.__name__] + list(args)):
+            module.main()
+
+    def test_grid(self):
+
+        """Ensure models can be applied to each downsampling of a grid run."""
+        empirical = os.path.join(self.temp_dir.name, 'empirical_grid')
+        self.run_main(cli_process_empirical_data, '--config', self.temp_config_file,
+                      '--downsampling', "{'pop1': 2, 'pop2': [2, 4]}", '--reps', '2',
+                      '--output', empirical)
+        subdirectory = os.path.join(empirical, 'pop22_pop12')
+        self.assertTrue(os.path.exists(os.path.join(subdirectory, 'empirical_sfs.npz')))
+
+        # a random forest taking the mSFS of the (pop2: 2, pop1: 2) downsampling
+        models = os.path.join(self.temp_dir.name, 'models')
+        os.makedirs(models)
+        rng = np.random.default_rng(1)
+        random_forest = RandomForestClassifier(n_estimators=5, random_state=1).fit(
+            rng.random((10, 9)), [0, 1] * 5)
+        with open(os.path.join(models, 'rf.model.pickle'), 'wb') as f:
+            pickle.dump(random_forest, f)
+
+        output = os.path.join(self.temp_dir.name, 'results')
+        self.run_main(cli_apply_models, '--config', self.temp_config_file, '--models', models,
+                      '--empirical', subdirectory, '--output', output, '--rf')
+        with open(os.path.join(output, 'rf_predictions.txt')) as f:
+            self.assertIn('Replicate 2', f.read())
+
+        # the alignment is written once, to the output directory
+        npt.assert_array_equal(cli_apply_models.read_empirical_array(subdirectory + os.sep),
+                               np.load(os.path.join(empirical, 'empirical.npy')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import unittest
+import subprocess
+import sys
+import numpy as np
+import numpy.testing as npt
+from collections import OrderedDict
+from scipy import sparse
+from sklearn.ensemble import RandomForestClassifier
+import keras
+from popai import build_predictors
+
+class TestPredictors(unittest.TestCase):
+
+    """Test the predictors built on simulated data and applied to empirical data."""
+
+    def setUp(self):
+        self.config = {'seed': 1}
+
+    def test_apply(self):
+
+        """Ensure the SFS predictors can be built without data, as when applying a model."""
+        rf = build_predictors.RandomForestsSFS(self.config, {}, {})
+        self.assertEqual(rf.sfs.shape, (0, 0))
+        model = RandomForestClassifier(n_estimators=2).fit([[0, 1], [1, 0]], [0, 1])
+        self.assertIn("Replicate 2", rf.predict(model, [np.array([0, 1]), np.array([1, 0])]))
+        fcnn = build_predictors.NeuralNetSFS(self.config, {}, {})
+        self.assertEqual(fcnn.sfs.shape, (0, 0))
+
+    def test_random_forest(self):
+
+        """Ensure the forest is built on sparse float32 spectra within the memory cap."""
+        rng = np.random.default_rng(1)
+        labels = np.repeat([0, 1], 20)
+        spectra = sparse.hstack([
+            sparse.csr_matrix(labels[:, np.newaxis] * 5 + rng.integers(0, 3, size=(40, 1))),
+            sparse.random(40, 14, density=0.3, random_state=1) * 10], format='csr')
+        rf = build_predictors.RandomForestsSFS(self.config, (spectra, labels), labels)
+        self.assertTrue(sparse.issparse(rf.sfs))
+        self.assertEqual(rf.sfs.dtype, np.float32)
+
+        # 4 trees of nodes of 64 bytes and 8 per class in 0.1 MB: 2*0.1*2**20/(4*80) nodes
+        model, _, _ = rf.build_rf_sfs(ntrees=4, cores=2, max_samples=0.5, max_memory=0.1)
+        self.assertEqual(model.max_leaf_nodes, int(0.1 * 2**20 / (4 * 80) + 1) // 2)
+        self.assertEqual(model.max_samples, 0.5)
+        self.assertEqual(model.n_jobs, 2)
+        self.assertEqual(len(model.estimators_), 4)
+
+        # a sample size above 1 is a number of datasets, and a tiny cap leaves two leaves
+        model, _, _ = rf.build_rf_sfs(ntrees=3, max_samples=10.0, max_memory=1e-6)
+        self.assertEqual(model.max_samples, 10)
+        self.assertIsInstance(model.max_samples, int)
+        self.assertEqual(model.max_leaf_nodes, 2)
+        self.assertTrue(all(tree.get_n_leaves() <= 2 for tree in model.estimators_))
+
+        model, _, _ = rf.build_rf_sfs(ntrees=3)
+        self.assertIsNone(model.max_leaf_nodes)
+        self.assertIsNone(model.max_samples)
+
+    def test_validate(self):
+
+        """Ensure predictions on the validation alignments are matched with their labels."""
+        labels = np.array([0, 0, 1, 1, 2, 2])
+        # the first site of each alignment is its label
+        arrays = np.zeros((6, 2, 3))
+        arrays[:, :, 0] = labels[:, np.newaxis]
+        config = {'seed': 1, 'sampling dict': OrderedDict([("A", 1), ("B", 1)])}
+        cnn = build_predictors.CnnNpy(config, (arrays, labels), labels)
+        conf_matrix, _ = cnn._validate(FirstSiteModel(), np.array([5, 0, 3, 1, 4, 2]), batch_size=4)
+        npt.assert_array_equal(conf_matrix, np.diag([2, 2, 2]))
+
+    def test_patience(self):
+
+        """Ensure training stops once the validation loss stops improving, with the best weights."""
+        keras.utils.set_random_seed(1)
+        # the validation labels are the opposite of the training labels, so the validation
+        # loss is lowest after the first epoch
+        features = np.eye(2, dtype=np.float32).repeat(10, axis=0)
+        labels = features.copy()
+        model = build_predictors.train_network(
+            dense_model(), features, labels, validation_data=(features, labels[:, ::-1]),
+            epochs=20, patience=2, learning_rate=0.1)
+        val_loss = model.history.history['val_loss']
+        self.assertEqual(len(val_loss), 3)
+        self.assertEqual(np.argmin(val_loss), 0)
+        npt.assert_allclose(model.evaluate(features, labels[:, ::-1], verbose=0)[0],
+                            val_loss[0], rtol=1e-5)
+
+    def test_decay(self):
+
+        """Ensure the learning rate is multiplied by decay after every epoch."""
+        features = np.eye(2, dtype=np.float32).repeat(10, axis=0)
+        model = build_predictors.train_network(dense_model(), features, features, epochs=3,
+                                               learning_rate=0.01, decay=0.5)
+        npt.assert_allclose(float(model.optimizer.learning_rate), 0.01 * 0.5**2)
+        model = build_predictors.train_network(dense_model(), features, features, epochs=3,
+                                               learning_rate=0.01)
+        npt.assert_allclose(float(model.optimizer.learning_rate), 0.01)
+
+    def test_threads(self):
+
+        """Ensure the TensorFlow thread pools are set, in a fresh interpreter."""
+        output = subprocess.run([sys.executable, "-c", "from popai import build_predictors; "
+            "build_predictors.set_threads(2, 3); import tensorflow as tf; "
+            "print(tf.config.threading.get_intra_op_parallelism_threads(), "
+            "tf.config.threading.get_inter_op_parallelism_threads())"],
+            capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split()[-2:], ["2", "3"])
+
+def dense_model():
+
+    """A single dense layer classifying two features into two classes."""
+
+    return keras.Sequential([keras.Input(shape=(2,)), keras.layers.Dense(2, activation='softmax')])
+
+class FirstSiteModel:
+
+    """A model predicting the value of the first site of the alignments."""
+
+    def predict(self, dataset):
+        predicted = [features[0].numpy()[:, 0, 0, 0] for features, _ in dataset]
+        return np.eye(3)[np.concatenate(predicted).astype(int)]
+
+if __name__ == '__main__':
+    unittest.main()
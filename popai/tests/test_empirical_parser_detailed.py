@@ -1,9 +1,10 @@
 import unittest
 import tempfile
 import os
+from unittest import mock
 import numpy as np
 import numpy.testing as npt
-from popai.parse_input import ModelConfigParser
+from popai.parse_input import ModelConfigParser, FastaReader
 from popai.process_empirical import DataProcessor
 
 class TestEmpiricalParser(unittest.TestCase):
@@ -68,9 +69,9 @@ popfile = ./tests/populations_mini.txt
         empirical_2d_sfs = data_processor.numpy_to_2d_sfs(
             empirical_array, downsampling={"pop1":2, "pop2":4}, replicates = 1)
         sfs_comp = {('pop2', 'pop1'): np.array([[0., 1., 0.],
-            [0., 0., 0.],
-            [1., 0., 0.],
+            [0., 0., 1.],
             [1., 0., 0.],
+            [0., 0., 0.],
             [0., 0., 0.]])}
         self.assertEqual(set(sfs_comp.keys()), set(empirical_2d_sfs[0].keys()))
         for key in sfs_comp:
@@ -92,13 +93,13 @@ popfile = ./tests/populations_mini.txt
         empirical_2d_sfs = data_processor.numpy_to_2d_sfs(
             empirical_array, downsampling={"pop1":2, "pop2":2}, replicates = 3)
         sfs_downs_1 = {('pop2', 'pop1'): np.array([
-                            [0., 1., 1.],
-                            [0., 0., 0.],
-                            [2., 0., 0.]])}
+                            [0., 1., 2.],
+                            [1., 0., 0.],
+                            [0., 0., 0.]])}
         sfs_downs_2 = {('pop2', 'pop1'): np.array([
                             [0., 1., 1.],
                             [0., 0., 0.],
-                            [2., 0., 0.]])}
+                            [1., 0., 0.]])}
         sfs_downs_3 = {('pop2', 'pop1'): np.array([
                             [0., 1., 2.],
                             [0., 0., 0.],
@@ -112,6 +113,37 @@ popfile = ./tests/populations_mini.txt
             npt.assert_array_equal(sfs_downs_2[key], empirical_2d_sfs[1][key])
         for key in sfs_downs_3:
             npt.assert_array_equal(sfs_downs_3[key], empirical_2d_sfs[2][key])
+    def test_fasta_reader(self):
+
+        """Ensure fasta files are encoded the same whether or not they are memory-mapped."""
+        alignment = FastaReader("./tests/mini_dataset/alignment.fa").read()
+        mapped = FastaReader("./tests/mini_dataset/alignment.fa", mmap_size=0).read()
+        self.assertEqual(alignment.taxa, ["n0", "n1", "n2", "n3", "n4", "n5"])
+        self.assertEqual(alignment.max_sequence_size, 13)
+        npt.assert_array_equal(alignment.encoded, mapped.encoded)
+        npt.assert_array_equal(alignment["n2"][:4], [0, -1, 1, 1])
+
+        # scanning gets the taxa and lengths without encoding the sequences
+        for mmap_size in (None, 0):
+            scanned = FastaReader("./tests/mini_dataset/alignment.fa", mmap_size=mmap_size).scan()
+            self.assertEqual(scanned.taxa, alignment.taxa)
+            self.assertEqual(scanned.max_sequence_size, 13)
+            self.assertEqual(scanned.encoded.size, 0)
+
+    def test_cache(self):
+
+        """Ensure a cached empirical matrix is reused without reading the alignments."""
+        parser = ModelConfigParser(self.temp_config_file)
+        config_values = parser.parse_config()
+        self.assertEqual(config_values['lengths'], [13])
+        self.assertEqual(config_values['fastas'][0].encoded.size, 0)
+        cache = os.path.join(self.temp_dir.name, 'cache')
+
+        empirical_array = DataProcessor(config=config_values, cache=cache).fasta_to_numpy()
+        npt.assert_array_equal(empirical_array, DataProcessor(config=config_values).fasta_to_numpy())
+        with mock.patch.object(FastaReader, 'read', side_effect=AssertionError):
+            cached_array = DataProcessor(config=config_values, cache=cache).fasta_to_numpy()
+        npt.assert_array_equal(empirical_array, cached_array)
 
 if __name__ == '__main__':
     unittest.main()
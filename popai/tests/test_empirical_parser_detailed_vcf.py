@@ -1,10 +1,14 @@
 import unittest
 import tempfile
 import os
+import gzip
+import shutil
+import functools
+from unittest import mock
 import numpy as np
 import numpy.testing as npt
-from popai.parse_input import ModelConfigParser
-from popai.process_empirical import DataProcessor
+from popai.parse_input import ModelConfigParser, VcfReader
+from popai.process_empirical import DataProcessor, expand_downsampling
 
 class TestEmpiricalParser(unittest.TestCase):
 
@@ -67,14 +71,17 @@ vcf = ./tests/mini_dataset/alignment.vcf
             [1,0,0,0]])
         npt.assert_array_equal(arr_comp, empirical_array)
         
+        # test downsampling preview
+        self.assertEqual(data_processor.find_downsampling(empirical_array), {(4, 2): 3, (2, 2): 4})
+
         # test 2D sfs without downsampling
         empirical_2d_sfs = data_processor.numpy_to_2d_sfs(
             empirical_array, downsampling={"pop1":2, "pop2":4}, replicates = 1)
         sfs_comp = {('pop2', 'pop1'): np.array(
             [[0., 1., 0.],
-            [0., 0., 0.],
-            [1., 0., 0.],
+            [0., 0., 1.],
             [1., 0., 0.],
+            [0., 0., 0.],
             [0., 0., 0.]])}
         self.assertEqual(set(sfs_comp.keys()), set(empirical_2d_sfs[0].keys()))
         for key in sfs_comp:
@@ -101,10 +108,10 @@ vcf = ./tests/mini_dataset/alignment.vcf
                             [0., 0., 0.]])}
         sfs_downs_2 = {('pop2', 'pop1'): np.array([
                             [0., 1., 1.],
-                            [2., 0., 0.],
-                            [0., 0., 0.]])}
+                            [0., 0., 0.],
+                            [1., 0., 0.]])}
         sfs_downs_3 = {('pop2', 'pop1'): np.array([
-                            [0., 1., 1.],
+                            [0., 1., 2.],
                             [0., 0., 0.],
                             [1., 0., 0.]])}
         self.assertEqual(set(sfs_downs_1.keys()), set(empirical_2d_sfs[0].keys()))
@@ -116,6 +123,231 @@ vcf = ./tests/mini_dataset/alignment.vcf
             npt.assert_array_equal(sfs_downs_2[key], empirical_2d_sfs[1][key])
         for key in sfs_downs_3:
             npt.assert_array_equal(sfs_downs_3[key], empirical_2d_sfs[2][key])
+    def test_vcf_reader_chunks(self):
+
+        """Ensure streaming the vcf in small blocks gives the same genotypes."""
+        samples = ["n1", "n2", "n0"]
+        whole = np.concatenate(list(VcfReader(
+            "./tests/mini_dataset/alignment.vcf").iter_genotypes(samples)), axis=1)
+        blocks = list(VcfReader(
+            "./tests/mini_dataset/alignment.vcf", chunksize=1).iter_genotypes(samples))
+        self.assertEqual(len(blocks), 4)
+        npt.assert_array_equal(whole, np.concatenate(blocks, axis=1))
+        npt.assert_array_equal(whole[:, 0], [-1, -1, 1, 1, 0, 0])
+    def test_vcf_reader_long_fields(self):
+
+        """Ensure GT and DP are decoded from long fields, in groups of samples."""
+        reader = VcfReader("./tests/mini_dataset/alignment.vcf")
+        formats = np.array(["GT:AD:DP:GQ:PL", "GT:AD:DP:GQ:PL", "GT:DP"], dtype=object)
+        fields = np.array([
+            ["0/1:10,12:22:99:255,0,255", "1|1:0,0:0:0:0,0,0", "./.:.:.:.:."],
+            ["10/1:0,3:3:9:90,9,0", "0/0:30,0:30:90:0,90,900", "1/0:1,0:0:3:0,3,30"],
+            ["0|1:12", "1|1:0", "0|0:120"]], dtype=object)
+        genotypes = [[0, 10, 0], [1, 1, 1], [-1, 0, -1], [-1, 0, -1], [-1, -1, 0], [-1, -1, 0]]
+        npt.assert_array_equal(reader._decode_block(formats, fields), genotypes)
+
+        dp_position = np.array([2, 2, 1], dtype=np.int8)
+        npt.assert_array_equal(reader._dp_zero(fields, dp_position, max_bytes=1),
+                               reader._dp_zero(fields, dp_position))
+        npt.assert_array_equal(reader._dp_zero(fields, dp_position),
+                               [[False, True, False], [False, False, True], [False, True, False]])
+
+    def test_vcf_reader_gzip_regions(self):
+
+        """Ensure compressed input and region restriction give the expected sites."""
+        samples = ["n1", "n2", "n0"]
+        gzipped = os.path.join(self.temp_dir.name, 'alignment.vcf.gz')
+        with open("./tests/mini_dataset/alignment.vcf", 'rb') as f_in, gzip.open(gzipped, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+        whole = np.concatenate(list(VcfReader(
+            "./tests/mini_dataset/alignment.vcf").iter_genotypes(samples)), axis=1)
+        npt.assert_array_equal(whole, np.concatenate(list(
+            VcfReader(gzipped).iter_genotypes(samples)), axis=1))
+
+        reader = VcfReader(gzipped, regions=["1:2-6"])
+        self.assertEqual(reader.read_header()['lengths'], [5])
+        npt.assert_array_equal(whole[:, 1:3], np.concatenate(list(
+            reader.iter_genotypes(samples)), axis=1))
+
+    def test_vcf_reader_overlapping_regions(self):
+
+        """Ensure sites in overlapping regions are read once, with or without an index."""
+        samples = ["n1", "n2", "n0"]
+        indexed = "./tests/mini_dataset/alignment.vcf.gz"
+        unindexed = os.path.join(self.temp_dir.name, 'alignment.vcf.gz')
+        shutil.copy(indexed, unindexed)
+
+        whole = np.concatenate(list(VcfReader(
+            "./tests/mini_dataset/alignment.vcf").iter_genotypes(samples)), axis=1)
+        for regions, sites in ((["1", "1:2-6"], [0, 1, 2, 3]), (["1:5-10", "1:2-6"], [1, 2, 3])):
+            for vcffile in (indexed, unindexed):
+                npt.assert_array_equal(whole[:, sites], np.concatenate(list(
+                    VcfReader(vcffile, regions=regions).iter_genotypes(samples)), axis=1))
+
+    def test_cache(self):
+
+        """Ensure a cached empirical matrix is reused and identical."""
+        parser = ModelConfigParser(self.temp_config_file)
+        config_values = parser.parse_config()
+        cache = os.path.join(self.temp_dir.name, 'cache')
+
+        empirical_array = DataProcessor(config=config_values, cache=cache).vcf_to_numpy()
+        self.assertEqual(len(os.listdir(cache)), 1)
+        cached_array = DataProcessor(config=config_values, cache=cache).vcf_to_numpy()
+        self.assertIsInstance(cached_array, np.memmap)
+        npt.assert_array_equal(empirical_array, cached_array)
+
+        # the cached matrix can be used directly
+        empirical_msfs, _ = DataProcessor(config=config_values).numpy_to_msfs(
+            cached_array, downsampling={"pop1":2, "pop2":4}, replicates = 1)
+        npt.assert_array_equal(empirical_msfs[0], [0, 1, 0, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 0])
+
+        # the key is the path, size and modification time of the inputs
+        popfile = os.path.join(self.temp_dir.name, 'populations.txt')
+        shutil.copy(config_values['popfile'], popfile)
+        config_values['popfile'] = popfile
+        DataProcessor(config=config_values, cache=cache).vcf_to_numpy()
+        self.assertEqual(len(os.listdir(cache)), 2)
+        os.utime(popfile, ns=(0, 0))
+        DataProcessor(config=config_values, cache=cache).vcf_to_numpy()
+        self.assertEqual(len(os.listdir(cache)), 3)
+
+    def test_blocks(self):
+
+        """Ensure results do not depend on how the data are split into blocks."""
+        parser = ModelConfigParser(self.temp_config_file)
+        config_values = parser.parse_config()
+        downsampling = {"pop1": 2, "pop2": 2}
+        whole = DataProcessor(config=config_values)
+        empirical_array = whole.vcf_to_numpy()
+        # without a cache the matrix is streamed to a temporary file as well
+        self.assertIsInstance(empirical_array, np.memmap)
+
+        # read the vcf one site at a time, and process the matrix one site at a time
+        blocks = DataProcessor(config=config_values, block_size=1)
+        with mock.patch('popai.process_empirical.VcfReader', functools.partial(VcfReader, chunksize=1)):
+            blocked_array = blocks.vcf_to_numpy()
+        npt.assert_array_equal(empirical_array, blocked_array)
+
+        self.assertEqual(whole.find_downsampling(empirical_array),
+                         blocks.find_downsampling(blocked_array))
+        for expected, observed in zip(whole.count_sites(empirical_array),
+                                      blocks.count_sites(blocked_array)):
+            npt.assert_array_equal(expected, observed)
+        expected = whole.numpy_to_sfs(empirical_array, downsampling, projection=True)
+        for observed in (blocks.numpy_to_sfs(blocked_array, downsampling, projection=True),
+                         blocks.numpy_to_sfs(blocks.count_sites(blocked_array), downsampling,
+                                             projection=True)):
+            npt.assert_allclose(expected[0][0], observed[0][0])
+            npt.assert_allclose(expected[1][0][('pop2', 'pop1')], observed[1][0][('pop2', 'pop1')])
+            self.assertEqual(expected[2], observed[2])
+
+    def test_projection(self):
+
+        """Ensure projected SFS are the expected subsampled SFS."""
+        parser = ModelConfigParser(self.temp_config_file)
+        config_values = parser.parse_config()
+        data_processor = DataProcessor(config=config_values)
+        empirical_array = data_processor.vcf_to_numpy()
+
+        # without downsampling the projection is the observed SFS
+        empirical_msfs, average_sites = data_processor.numpy_to_msfs(
+            empirical_array, downsampling={"pop1":2, "pop2":4}, projection=True)
+        self.assertEqual(average_sites, 3)
+        npt.assert_array_equal(empirical_msfs[0], [0, 1, 0, 0, 0, 0, 1, 0, 0, 1, 0, 0, 0, 0, 0])
+
+        empirical_msfs, average_sites = data_processor.numpy_to_msfs(
+            empirical_array, downsampling={"pop1":2, "pop2":2}, projection=True)
+        self.assertEqual(len(empirical_msfs), 1)
+        npt.assert_allclose(empirical_msfs[0], [0, 1, 1, 7/6, 0, 0, 2/3, 0, 0])
+
+        # a site with tied allele counts is split between both orientations
+        empirical_2d_sfs = data_processor.numpy_to_2d_sfs(
+            empirical_array, downsampling={"pop1":2, "pop2":4}, projection=True)
+        npt.assert_array_equal(empirical_2d_sfs[0][('pop2', 'pop1')],
+            [[0, 1, 0], [0, 0, 0.5], [1, 0, 0], [0.5, 0, 0], [0, 0, 0]])
+
+        # which is also the marginal of the projected mSFS
+        empirical_msfs, _ = data_processor.numpy_to_msfs(
+            empirical_array, downsampling={"pop1":2, "pop2":4}, projection=True)
+        marginal_2d_sfs = data_processor.msfs_to_2d_sfs(
+            empirical_msfs, downsampling={"pop1":2, "pop2":4})
+        npt.assert_array_equal(marginal_2d_sfs[0][('pop2', 'pop1')],
+            empirical_2d_sfs[0][('pop2', 'pop1')])
+
+    def test_combined(self):
+
+        """Ensure the mSFS and 2D SFS built in one pass match those built separately."""
+        parser = ModelConfigParser(self.temp_config_file)
+        config_values = parser.parse_config()
+        data_processor = DataProcessor(config=config_values)
+        empirical_array = data_processor.vcf_to_numpy()
+        downsampling = {"pop1":2, "pop2":2}
+
+        # replicates draw the same subsamples for the mSFS as numpy_to_msfs
+        empirical_msfs, empirical_2d_sfs, average_sites = data_processor.numpy_to_sfs(
+            empirical_array, downsampling=downsampling, replicates=3)
+        separate_msfs, separate_sites = DataProcessor(config=config_values).numpy_to_msfs(
+            empirical_array, downsampling=downsampling, replicates=3)
+        self.assertEqual(average_sites, separate_sites)
+        self.assertEqual(len(empirical_2d_sfs), 3)
+        for replicate in range(3):
+            npt.assert_array_equal(empirical_msfs[replicate], separate_msfs[replicate])
+            self.assertEqual(list(empirical_2d_sfs[replicate]), [('pop2', 'pop1')])
+
+        # the projection is computed once for both spectra
+        empirical_msfs, empirical_2d_sfs, _ = data_processor.numpy_to_sfs(
+            empirical_array, downsampling=downsampling, projection=True)
+        npt.assert_allclose(empirical_msfs[0], data_processor.numpy_to_msfs(
+            empirical_array, downsampling=downsampling, projection=True)[0][0])
+        npt.assert_allclose(empirical_2d_sfs[0][('pop2', 'pop1')], data_processor.numpy_to_2d_sfs(
+            empirical_array, downsampling=downsampling, projection=True)[0][('pop2', 'pop1')])
+
+        # with marginal, the 2D SFS are the marginals of the mSFS
+        empirical_msfs, empirical_2d_sfs, _ = data_processor.numpy_to_sfs(
+            empirical_array, downsampling=downsampling, replicates=2, marginal=True)
+        marginal_2d_sfs = data_processor.msfs_to_2d_sfs(empirical_msfs, downsampling=downsampling)
+        for replicate in range(2):
+            npt.assert_array_equal(empirical_2d_sfs[replicate][('pop2', 'pop1')],
+                                   marginal_2d_sfs[replicate][('pop2', 'pop1')])
+
+    def test_grid(self):
+
+        """Ensure several downsamplings are processed from shared site counts."""
+        self.assertEqual(expand_downsampling({"pop1": 2, "pop2": [2, 4]}),
+                         [{"pop1": 2, "pop2": 2}, {"pop1": 2, "pop2": 4}])
+        self.assertEqual(expand_downsampling([{"pop1": 2, "pop2": 2}]), [{"pop1": 2, "pop2": 2}])
+
+        parser = ModelConfigParser(self.temp_config_file)
+        config_values = parser.parse_config()
+        data_processor = DataProcessor(config=config_values, cores=2)
+        empirical_array = data_processor.vcf_to_numpy()
+        present, minor = data_processor.count_sites(empirical_array)
+        self.assertEqual(present.shape, (2, 4))
+        npt.assert_array_equal(present, [[2, 4, 4, 4], [2, 2, 2, 2]])
+        npt.assert_array_equal(minor, [[0, 0, 3, 2], [2, 1, 0, 0]])
+
+        downsamplings = expand_downsampling({"pop1": 2, "pop2": [2, 4]})
+        results = data_processor.numpy_to_sfs_grid(empirical_array, downsamplings, projection=True)
+        self.assertEqual(len(results), 2)
+        for downsampling, (empirical_msfs, empirical_2d_sfs, _) in zip(downsamplings, results):
+            separate_msfs, separate_2d_sfs, _ = data_processor.numpy_to_sfs(
+                empirical_array, downsampling=downsampling, projection=True)
+            npt.assert_allclose(empirical_msfs[0], separate_msfs[0])
+            npt.assert_allclose(empirical_2d_sfs[0][('pop2', 'pop1')],
+                                separate_2d_sfs[0][('pop2', 'pop1')])
+
+        # replicates are drawn from the same sites as with the alignment
+        results = data_processor.numpy_to_sfs_grid((present, minor), downsamplings, replicates=2)
+        self.assertEqual(len(results[1][0]), 2)
+        self.assertEqual(results[1][2], 3)
+
+        # the draws do not depend on the number of processes
+        parallel, serial = (DataProcessor(config=config_values, cores=cores).numpy_to_sfs_grid(
+            (present, minor), downsamplings, replicates=2) for cores in (2, 1))
+        for (parallel_msfs, _, _), (serial_msfs, _, _) in zip(parallel, serial):
+            npt.assert_array_equal(parallel_msfs, serial_msfs)
 
 if __name__ == '__main__':
     unittest.main()
@@ -69,9 +69,9 @@ popfile = ./tests/populations_mini.txt
             empirical_array, downsampling={"pop1":2, "pop2":4}, replicates = 1)
         sfs_comp = {('pop2', 'pop1'): np.array([
             [0., 1., 0.],
-            [0., 0., 0.],
-            [1., 0., 0.],
+            [0., 0., 1.],
             [1., 0., 0.],
+            [0., 0., 0.],
             [0., 0., 0.]])}
         self.assertEqual(set(sfs_comp.keys()), set(empirical_2d_sfs[0].keys()))
         for key in sfs_comp:
@@ -94,16 +94,16 @@ popfile = ./tests/populations_mini.txt
             empirical_array, downsampling={"pop1":2, "pop2":2}, replicates = 3)
         sfs_downs_1 = {('pop2', 'pop1'): np.array([
                             [0., 1., 0.],
-                            [2., 0., 0.],
-                            [0., 0., 0.]])}
+                            [1., 0., 0.],
+                            [1., 0., 0.]])}
         sfs_downs_2 = {('pop2', 'pop1'): np.array([
-                            [0., 1., 1.],
+                            [0., 1., 0.],
                             [0., 0., 0.],
                             [1., 0., 0.]])}
         sfs_downs_3 = {('pop2', 'pop1'): np.array([
-                            [0., 1., 0.],
-                            [2., 0., 0.],
-                            [0., 0., 0.]])}
+                            [0., 1., 1.],
+                            [0., 0., 0.],
+                            [1., 0., 0.]])}
         self.assertEqual(set(sfs_downs_1.keys()), set(empirical_2d_sfs[0].keys()))
         self.assertEqual(set(sfs_downs_2.keys()), set(empirical_2d_sfs[1].keys()))
         self.assertEqual(set(sfs_downs_3.keys()), set(empirical_2d_sfs[2].keys()))
@@ -0,0 +1,142 @@
+import unittest
+import tempfile
+import os
+import sys
+from collections import OrderedDict
+from unittest import mock
+import numpy as np
+import numpy.testing as npt
+from popai import build_predictors, cli_project_simulations, cli_train_models
+from popai.parse_input import ModelConfigParser
+from popai.sfs import SFSLayout, SFSPyramid, limit_sites
+from popai.simulate_data import DataSimulator
+from popai.training_data import TrainingData
+from popai.utils import limit_alignment_sites
+
+class TestProjectSimulations(unittest.TestCase):
+
+    """Test projecting simulations at the full sample sizes to a smaller downsampling."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.temp_config_file = os.path.join(self.temp_dir.name, 'test_config.ini')
+
+        # Create a sample config file for testing
+        with open(self.temp_config_file, 'w', encoding='utf-8') as f:
+            f.write("""
+[Model]
+species tree file = ./tests/species_tree_mini.nex
+migration matrix = ./tests/migration_mini.txt
+symmetric = True
+secondary contact = True
+divergence with gene flow = False
+max migration events = 1
+migration rate = U(1e-5, 1e-4)
+constant Ne = True # population sizes equal across all populations
+
+[Other]
+output directory = ./examples/test_mini
+seed = 1234
+replicates = 10
+
+[Simulations]
+mutation rate = U(1e-8, 1e-7)
+substitution model = JC69
+
+[Data]
+alignments = ./tests/mini_dataset/
+popfile = ./tests/populations_mini.txt
+
+            """)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def simulate_full(self, max_sites=40):
+
+        """Write random alignments of all sampled haplotypes as simulate_data --full does."""
+        config_values = ModelConfigParser(self.temp_config_file).parse_config()
+        rng = np.random.default_rng(1)
+        arrays = OrderedDict((model, [rng.integers(0, 2, size=(6, max_sites), dtype=np.int8) \
+                                      for _ in range(3)]) for model in (0, 1))
+        simulator = DataSimulator([], [], config=config_values, cores=1,
+                                  downsampling=dict(config_values['sampling dict']),
+                                  max_sites=max_sites, user=True)
+        msfs = simulator.mutations_to_sfs(arrays, sparse=True)
+        simulations = os.path.join(self.temp_dir.name, 'simulated_full')
+        TrainingData.from_dicts(os.path.join(simulations, 'training_data'), msfs=msfs,
+                                arrays=arrays)
+        SFSPyramid.from_dict(simulator.layout, msfs).save(
+            os.path.join(simulations, 'simulated_msfs.npz'), spectra=False)
+        np.save(os.path.join(simulations, 'labels.npy'), np.array([0, 1]), allow_pickle=True)
+        return simulations, simulator.layout, msfs
+
+    def project(self, simulations, downsampling, *options):
+        output = os.path.join(self.temp_dir.name, 'simulated')
+        argv = ['project_simulations', '--config', self.temp_config_file, '--simulations',
+                simulations, '--downsampling', downsampling, '--output', output, '--force']
+        with mock.patch.object(sys, 'argv', argv + list(options)):
+            cli_project_simulations.main()
+        return TrainingData(os.path.join(output, 'training_data'))
+
+    def test_project_simulations(self):
+
+        """Ensure projected spectra have at most --maxsites SNPs, like direct simulations."""
+        simulations, layout, msfs = self.simulate_full()
+
+        # projecting to the full sample sizes keeps the (folded) spectra
+        store = self.project(simulations, "{'pop1': 2, 'pop2': 4}")
+        full = np.array([x.toarray()[0] for values in msfs.values() for x in values], dtype=float)
+        npt.assert_allclose(store.msfs(), layout.fold(full))
+        npt.assert_array_equal(store.labels(), [0, 0, 0, 1, 1, 1])
+
+        # subsamples have fewer SNPs, which are scaled down to --maxsites
+        store = self.project(simulations, "{'pop1': 2, 'pop2': 2}")
+        sites = store.msfs().sum(axis=1)
+        self.assertTrue(np.all(sites < full.sum(axis=1)))
+        store = self.project(simulations, "{'pop1': 2, 'pop2': 2}", '--maxsites', '10')
+        npt.assert_allclose(store.msfs().sum(axis=1), np.minimum(sites, 10))
+        self.assertEqual(store.arrays().shape, (6, 6, 10))
+
+    def test_invalid_downsampling(self):
+
+        """Ensure a malformed downsampling dictionary is reported rather than raised."""
+        simulations, _, _ = self.simulate_full()
+        for downsampling in ("{'pop1': 2", "2"):
+            with mock.patch('builtins.print') as printed:
+                self.project(simulations, downsampling)
+            printed.assert_called_with('Error: Invalid downsampling dictionary. Please provide a valid dictionary string.')
+
+    def test_train_cnn_npy(self):
+
+        """Ensure the CNN can be trained on projected alignments."""
+        simulations, _, _ = self.simulate_full()
+        self.project(simulations, "{'pop1': 2, 'pop2': 2}", '--maxsites', '10')
+        output = os.path.join(self.temp_dir.name, 'models')
+        argv = ['train_models', '--config', self.temp_config_file, '--simulations',
+                os.path.join(self.temp_dir.name, 'simulated'), '--output', output,
+                '--cnnnpy', '--epochs', '1', '--batch', '2']
+        # TensorFlow threads can only be set in a fresh interpreter
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.object(build_predictors, 'set_threads'):
+            cli_train_models.main()
+        self.assertTrue(os.path.exists(os.path.join(output, 'cnn_npy.keras')))
+
+    def test_limit_alignment_sites(self):
+
+        """Ensure the first sites of all haplotypes are kept, padded with missing data."""
+        arr = np.array([[0, 1, 0, 1],
+                        [1, 0, 1, 1]], dtype=np.int8)
+        npt.assert_array_equal(limit_alignment_sites(arr, 2), [[0, 1], [1, 0]])
+        npt.assert_array_equal(limit_alignment_sites(arr, 6),
+                               [[0, 1, 0, 1, -1, -1], [1, 0, 1, 1, -1, -1]])
+
+    def test_limit_sites(self):
+
+        """Ensure spectra with more sites are scaled down to the maximum."""
+        spectra = np.array([[0, 2, 2], [0, 1, 0]])
+        npt.assert_allclose(limit_sites(spectra, 2), [[0, 1, 1], [0, 1, 0]])
+        npt.assert_allclose(limit_sites(np.zeros((1, 3)), 2), 0)
+
+if __name__ == '__main__':
+    unittest.main()
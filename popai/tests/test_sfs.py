@@ -0,0 +1,176 @@
+import unittest
+import tempfile
+import os
+from collections import OrderedDict
+import numpy as np
+import numpy.testing as npt
+from scipy import sparse, stats
+from popai.sfs import SFSLayout, SFSPyramid
+from popai.utils import hypergeometric_pmf
+
+class TestSFSLayout(unittest.TestCase):
+
+    """Test the SFS layout shared by simulated and empirical data."""
+
+    def setUp(self):
+        self.layout = SFSLayout(OrderedDict([("A", 2), ("B", 4)]))
+
+    def test_layout(self):
+
+        """Ensure cells are laid out with the last population varying fastest."""
+        self.assertEqual(self.layout.shape, (3, 5))
+        self.assertEqual(self.layout.size, 15)
+        npt.assert_array_equal(self.layout.index(np.array([[0, 1, 2], [1, 0, 4]])), [1, 5, 14])
+
+    def test_histogram(self):
+
+        """Ensure sites are counted per replicate, leaving out masked sites."""
+        counts = np.array([[[0, 1, 1], [2, 2, 0]],
+                           [[1, 0, 0], [4, 4, 3]]])
+        sfs = self.layout.histogram(counts, mask=np.array([True, True, False]))
+        self.assertEqual(sfs.shape, (2, 15))
+        npt.assert_array_equal(sfs.reshape(2, 3, 5)[0], [[0, 1, 0, 0, 0],
+                                                         [1, 0, 0, 0, 0],
+                                                         [0, 0, 0, 0, 0]])
+        npt.assert_array_equal(sfs.reshape(2, 3, 5)[1], [[0, 0, 0, 0, 0],
+                                                         [0, 0, 0, 0, 0],
+                                                         [0, 0, 0, 0, 2]])
+
+    def test_bin(self):
+
+        """Ensure binning merges cells, and repeated bounds, as expected."""
+        sfs = np.arange(15)
+        self.assertEqual(self.layout.thresholds(2), [[1, 2], [2, 4]])
+        npt.assert_array_equal(self.layout.bin(sfs, 2), [0+1+2+5+6+7, 3+4+8+9,
+                                                         10+11+12, 13+14])
+        self.assertEqual(self.layout.thresholds(4), [[0, 1, 2], [1, 2, 3, 4]])
+        npt.assert_array_equal(self.layout.bin_index(4)[0], [0, 1, 2])
+        npt.assert_array_equal(self.layout.bin_index(4)[1], [0, 0, 1, 2, 3])
+        self.assertEqual(self.layout.bin(sfs, 4).shape, (12,))
+        self.assertEqual(self.layout.bin(sfs, 4).sum(), sfs.sum())
+
+    def test_pairwise(self):
+
+        """Ensure pairwise spectra are folded marginals of the mSFS."""
+        layout = SFSLayout(OrderedDict([("A", 2), ("B", 2), ("C", 2)]))
+        sfs = np.zeros(layout.shape)
+        sfs[1, 0, 0] = 1 # private to A
+        sfs[2, 2, 1] = 3 # fixed in A and B
+        sfs[2, 0, 0] = 2 # tied in A and B, and in A and C
+        joint_sfs = layout.pairwise(sfs.ravel())
+        self.assertEqual(list(joint_sfs), [("A", "B"), ("A", "C"), ("B", "C")])
+        npt.assert_array_equal(joint_sfs[("A", "B")], [[0, 0, 1], [1, 0, 0], [1, 0, 0]])
+        npt.assert_array_equal(joint_sfs[("A", "C")], [[0, 3, 1], [1, 0, 0], [1, 0, 0]])
+        npt.assert_array_equal(joint_sfs[("B", "C")], [[0, 3, 0], [0, 0, 0], [0, 0, 0]])
+
+    def test_project(self):
+
+        """Ensure projected spectra are the expected spectra of smaller samples."""
+        sfs = np.zeros(15)
+        sfs[self.layout.index(np.array([1, 2]))] = 4
+        projected, layout = self.layout.project(sfs, {"A": 2, "B": 4})
+        npt.assert_array_equal(projected[0], self.layout.fold(sfs))
+        # drawing 2 of the 4 haplotypes of B keeps 0, 1 or 2 copies with probability 1/6,
+        # 4/6 and 1/6; 2 copies out of 4 are tied, and 3 copies are folded back to 1
+        projected, layout = self.layout.project(sfs, {"B": 2, "A": 2})
+        self.assertEqual(layout.populations, ["A", "B"])
+        npt.assert_allclose(projected.reshape(layout.shape),
+                            [[0, 0, 0], [4/3, 8/3, 0], [0, 0, 0]])
+        projected, layout = self.layout.project(sparse.csr_matrix(sfs), {"A": 2, "B": 2})
+        npt.assert_allclose(projected.sum(), 4)
+        with self.assertRaises(ValueError):
+            self.layout.project(sfs, {"A": 4, "B": 2})
+
+    def test_hypergeometric(self):
+
+        """Ensure hypergeometric probabilities are computed for the requested rows only."""
+        present = np.array([2000, 1500, 10, 4])
+        minor = np.array([700, 1500, 3, 0])
+        pmf = hypergeometric_pmf(present, minor, 20)
+        self.assertEqual(pmf.shape, (4, 21))
+        for row in range(2):
+            npt.assert_allclose(pmf[row], stats.hypergeom.pmf(
+                np.arange(21), present[row], minor[row], 20), atol=1e-12)
+        # fewer haplotypes than the sample
+        npt.assert_array_equal(pmf[2:], 0)
+        npt.assert_allclose(hypergeometric_pmf(4, np.arange(5), 2)[2], [1/6, 4/6, 1/6])
+
+    def test_sparse(self):
+
+        """Ensure sparse spectra match dense spectra."""
+        counts = np.array([[[0, 1, 1, 2], [2, 2, 0, 2]],
+                           [[1, 0, 0, 4], [4, 4, 3, 4]]])
+        dense = self.layout.histogram(counts)
+        sparse_sfs = self.layout.histogram(counts, sparse_output=True)
+        self.assertEqual(sparse_sfs.shape, (2, 15))
+        npt.assert_array_equal(sparse_sfs.toarray(), dense)
+        npt.assert_array_equal(self.layout.bin(sparse_sfs, 2).toarray(), self.layout.bin(dense, 2))
+        joint_sfs = self.layout.pairwise(sparse_sfs)
+        npt.assert_array_equal(joint_sfs[("A", "B")], self.layout.pairwise(dense)[("A", "B")])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'msfs.npz')
+            pyramid = SFSPyramid(self.layout, sparse_sfs)
+            pyramid.level(2)
+            pyramid.save(path)
+            loaded = SFSPyramid.load(path)
+        npt.assert_array_equal(loaded.spectra.toarray(), dense)
+        npt.assert_array_equal(loaded.levels[2].toarray(), self.layout.bin(dense, 2))
+
+    def test_pyramid(self):
+
+        """Ensure binned levels are derived from, and saved with, the full spectra."""
+        sfs_dict = {0: [np.arange(15), np.ones(15, dtype=int)], 1: [np.arange(15)[::-1]]}
+        pyramid = SFSPyramid.from_dict(self.layout, sfs_dict)
+        npt.assert_array_equal(pyramid.level(), np.stack(sfs_dict[0] + sfs_dict[1]))
+        npt.assert_array_equal(pyramid.to_dict(2)[0][1], [6, 4, 3, 2])
+        self.assertEqual(list(pyramid.levels), [2])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'msfs.npz')
+            pyramid.save(path)
+            loaded = SFSPyramid.load(path)
+        self.assertEqual(loaded.layout.shape, (3, 5))
+        self.assertEqual(loaded.keys, [0, 0, 1])
+        npt.assert_array_equal(loaded.levels[2], pyramid.level(2))
+        npt.assert_array_equal(loaded.to_dict()[1][0], sfs_dict[1][0])
+
+    def test_pyramid_spectra(self):
+
+        """Ensure a pyramid saved without its full-resolution spectra is read with them."""
+        spectra = np.arange(30).reshape(2, 15)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'msfs.npz')
+            SFSPyramid(self.layout, spectra, keys=[0, 1]).save(path, spectra=False)
+            with self.assertRaises(ValueError):
+                SFSPyramid.load(path)
+            loaded = SFSPyramid.load(path, spectra=spectra)
+            npt.assert_array_equal(loaded.level(), spectra)
+
+            # derived levels are added to the file, still without the spectra
+            loaded.level(2)
+            loaded.save(path)
+            self.assertEqual(os.listdir(temp_dir), ['msfs.npz'])
+            with np.load(path) as data:
+                self.assertNotIn('spectra', data)
+            loaded = SFSPyramid.load(path, spectra=spectra)
+            npt.assert_array_equal(loaded.levels[2], self.layout.bin(spectra, 2))
+
+    def test_joint(self):
+
+        """Ensure joint SFS and the default number of bins are saved with the mSFS."""
+        joint = [(("A", "B"), np.arange(30).reshape(2, 3, 5))]
+        pyramid = SFSPyramid(self.layout, np.ones((2, 15)), joint=joint, nbins=2)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'sfs.npz')
+            pyramid.save(path)
+            loaded = SFSPyramid.load(path)
+        self.assertEqual(loaded.nbins, 2)
+        self.assertEqual(list(loaded.joint), [("A", "B")])
+        joint_sfs = loaded.joint_dicts()
+        self.assertEqual(len(joint_sfs), 2)
+        npt.assert_array_equal(joint_sfs[1][("A", "B")], np.arange(15, 30).reshape(3, 5))
+        self.assertIsNone(SFSPyramid(self.layout, np.ones((2, 15))).nbins)
+
+if __name__ == '__main__':
+    unittest.main()
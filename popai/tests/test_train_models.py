@@ -0,0 +1,67 @@
+import unittest
+import tempfile
+import os
+import sys
+import pickle
+from unittest import mock
+import numpy as np
+from popai import cli_train_models
+
+class TestTrainModels(unittest.TestCase):
+
+    """Test the command-line interface for training models."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.temp_config_file = os.path.join(self.temp_dir.name, 'test_config.ini')
+
+        # Create a sample config file for testing
+        with open(self.temp_config_file, 'w', encoding='utf-8') as f:
+            f.write("""
+[Model]
+species tree file = ./tests/species_tree_mini.nex
+migration matrix = ./tests/migration_mini.txt
+symmetric = True
+secondary contact = True
+divergence with gene flow = False
+max migration events = 1
+migration rate = U(1e-5, 1e-4)
+constant Ne = True # population sizes equal across all populations
+
+[Other]
+output directory = ./examples/test_mini
+seed = 1234
+replicates = 10
+
+[Simulations]
+mutation rate = U(1e-8, 1e-7)
+substitution model = JC69
+
+[Data]
+alignments = ./tests/mini_dataset/
+popfile = ./tests/populations_mini.txt
+
+            """)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_nbins_legacy(self):
+
+        """Ensure --nbins on simulations without full-resolution mSFS fails clearly."""
+        simulations = os.path.join(self.temp_dir.name, 'simulated')
+        os.makedirs(simulations)
+        rng = np.random.default_rng(1)
+        with open(os.path.join(simulations, 'simulated_msfs.pickle'), 'wb') as f:
+            pickle.dump({0: list(rng.random((3, 9))), 1: list(rng.random((3, 9)))}, f)
+        np.save(os.path.join(simulations, 'labels.npy'), np.array([0, 1]), allow_pickle=True)
+
+        argv = ['train_models', '--config', self.temp_config_file, '--simulations', simulations,
+                '--output', os.path.join(self.temp_dir.name, 'models'), '--rf', '--nbins', '2']
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch('popai.build_predictors.set_threads'):
+            with self.assertRaisesRegex(RuntimeError, 'simulated_msfs.npz'):
+                cli_train_models.main()
+
+if __name__ == '__main__':
+    unittest.main()
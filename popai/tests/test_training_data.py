@@ -0,0 +1,50 @@
+import unittest
+import tempfile
+import numpy as np
+import numpy.testing as npt
+from scipy import sparse
+from popai.training_data import TrainingData
+
+class TestTrainingData(unittest.TestCase):
+
+    """Test the store of simulated training data."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.msfs = {0: [np.arange(4), np.ones(4, dtype=int)], 1: [np.arange(4)[::-1]]}
+        self.jsfs = {0: [{("A", "B"): np.full((2, 3), 1.), ("A", "C"): np.full((2, 2), 2.)},
+                         {("A", "B"): np.full((2, 3), 3.), ("A", "C"): np.full((2, 2), 4.)}],
+                     1: [{("A", "B"): np.full((2, 3), 5.), ("A", "C"): np.full((2, 2), 6.)}]}
+        self.arrays = {0: [np.zeros((4, 5), dtype=int), np.ones((4, 5), dtype=int)],
+                       1: [np.full((4, 5), -1)]}
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_store(self):
+
+        """Ensure features are stacked in the order of the datasets and memory-mapped."""
+        store = TrainingData.from_dicts(self.temp_dir.name, msfs=self.msfs, jsfs=self.jsfs,
+                                        arrays=self.arrays)
+        npt.assert_array_equal(store.labels(), [0, 0, 1])
+        self.assertIsInstance(store.msfs(), np.memmap)
+        npt.assert_array_equal(store.msfs(), np.stack(self.msfs[0] + self.msfs[1]))
+        jsfs = store.jsfs()
+        self.assertEqual(list(jsfs), [("A", "B"), ("A", "C")])
+        self.assertEqual(jsfs[("A", "B")].shape, (3, 2, 3))
+        npt.assert_array_equal(jsfs[("A", "C")][:, 0, 0], [2, 4, 6])
+        npt.assert_array_equal(store.arrays()[:, 0, 0], [0, 1, -1])
+        self.assertIn("arrays", store)
+
+    def test_sparse(self):
+
+        """Ensure sparse mSFS are stored and read back as sparse matrices."""
+        msfs = {key: [sparse.csr_matrix(x) for x in values] for key, values in self.msfs.items()}
+        store = TrainingData.from_dicts(self.temp_dir.name, msfs=msfs)
+        self.assertTrue(sparse.issparse(store.msfs()))
+        npt.assert_array_equal(store.msfs().toarray(), np.stack(self.msfs[0] + self.msfs[1]))
+        self.assertIn("msfs", store)
+        self.assertNotIn("jsfs", store)
+
+if __name__ == '__main__':
+    unittest.main()